@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""Generate synthetic MIPS assembly for benchmarking, with functions whose
+size and shape are controlled by a single parameter."""
+
+import argparse
+import sys
+from typing import Callable, Dict, List
+
+LOOP_REGS = ["t0", "t1", "t2", "t3", "t4", "t5", "t7", "t8", "t9"]
+ARG_REGS = ["a0", "a1", "a2", "a3"]
+
+
+def straight_line(name: str, size: int) -> List[str]:
+    """A single basic block of `size` groups of two loads, an addition and a
+    store."""
+    lines = [f"glabel {name}"]
+    for i in range(size):
+        offset = (i % 64) * 4
+        lines.append(f"  lw $t0, {offset:#x}($a0)")
+        lines.append(f"  lw $t1, {offset:#x}($a1)")
+        lines.append("  addu $t2, $t0, $t1")
+        lines.append(f"  sw $t2, {offset:#x}($a2)")
+    lines += ["  jr $ra", "   nop"]
+    return lines
+
+
+def nested_ifs(name: str, size: int) -> List[str]:
+    """`size` if statements, each nested inside the previous one."""
+    lines = [f"glabel {name}", "  move $v0, $zero"]
+    for i in range(size):
+        lines.append(f"  beqz ${ARG_REGS[i % 4]}, .L{name}_end{i}")
+        lines.append("   nop")
+        lines.append(f"  addiu $v0, $v0, {i + 1}")
+    for i in reversed(range(size)):
+        lines.append(f".L{name}_end{i}:")
+        lines.append("  addiu $v0, $v0, 1")
+    lines += ["  jr $ra", "   nop"]
+    return lines
+
+
+def jump_table(name: str, size: int) -> List[str]:
+    """A switch statement with `size` cases, using a jump table."""
+    base = 0x400000 + (sum(map(ord, name)) << 16)
+    case_labels = [f"L{base + i * 0x10:08X}" for i in range(size)]
+    lines = [
+        ".rdata",
+        f"glabel jtbl_{name}",
+        *[f".word {label}" for label in case_labels],
+        "",
+        ".text",
+        f"glabel {name}",
+        f"  sltiu $at, $a0, {size}",
+        f"  beqz $at, .L{name}_default",
+        "   sll $t6, $a0, 2",
+        f"  lui $at, %hi(jtbl_{name})",
+        "  addu $at, $at, $t6",
+        f"  lw $t6, %lo(jtbl_{name})($at)",
+        "  jr $t6",
+        "   nop",
+    ]
+    for i, label in enumerate(case_labels):
+        lines += [
+            f"glabel {label}",
+            f".{label}:",
+            f"  li $v0, {i * 3 + 1}",
+            f"  b .L{name}_ret",
+            "   nop",
+        ]
+    lines += [
+        f".L{name}_default:",
+        "  li $v0, -1",
+        f".L{name}_ret:",
+        "  jr $ra",
+        "   nop",
+    ]
+    return lines
+
+
+def nested_loops(name: str, size: int) -> List[str]:
+    """`size` loops, each nested inside the previous one."""
+    lines = [f"glabel {name}", "  move $v0, $zero"]
+    for i in range(size):
+        reg = LOOP_REGS[i % len(LOOP_REGS)]
+        lines.append(f"  move ${reg}, $zero")
+        lines.append(f".L{name}_loop{i}:")
+    lines.append("  addiu $v0, $v0, 1")
+    for i in reversed(range(size)):
+        reg = LOOP_REGS[i % len(LOOP_REGS)]
+        lines.append(f"  addiu ${reg}, ${reg}, 1")
+        lines.append(f"  slti $at, ${reg}, 10")
+        lines.append(f"  bnez $at, .L{name}_loop{i}")
+        lines.append("   nop")
+    lines += ["  jr $ra", "   nop"]
+    return lines
+
+
+def early_returns(name: str, size: int) -> List[str]:
+    """`size` comparisons, each of which may return early."""
+    lines = [f"glabel {name}"]
+    for i in range(size):
+        lines.append(f"  addiu $at, $zero, {i}")
+        lines.append(f"  beq $a0, $at, .L{name}_ret{i}")
+        lines.append("   nop")
+    lines += ["  jr $ra", "   li $v0, -1"]
+    for i in range(size):
+        lines += [f".L{name}_ret{i}:", "  jr $ra", f"   li $v0, {i * 2}"]
+    return lines
+
+
+GENERATORS: Dict[str, Callable[[str, int], List[str]]] = {
+    "straight_line": straight_line,
+    "nested_ifs": nested_ifs,
+    "jump_table": jump_table,
+    "nested_loops": nested_loops,
+    "early_returns": early_returns,
+}
+
+
+def generate(kind: str, size: int, count: int = 1) -> str:
+    """Generate a file with `count` functions of the given kind and size."""
+    lines = [".set noat", ".set noreorder", "", ".text"]
+    for i in range(count):
+        lines += GENERATORS[kind](f"{kind}_{size}_{i}", size)
+        lines.append("")
+    return "\n".join(lines) + "\n"
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("kind", choices=sorted(GENERATORS))
+    parser.add_argument("size", type=int, help="size of each function")
+    parser.add_argument(
+        "--count", type=int, default=1, help="number of functions to generate"
+    )
+    args = parser.parse_args()
+    sys.stdout.write(generate(args.kind, args.size, args.count))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
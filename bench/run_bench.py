@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""Benchmark the decompiler on synthetic functions of increasing size,
+reporting time and peak memory for each stage of decompilation."""
+
+import argparse
+import contextlib
+import gc
+import io
+import json
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from generate import GENERATORS, generate  # noqa: E402
+from src.flow_graph import build_flowgraph  # noqa: E402
+from src.if_statements import write_function  # noqa: E402
+from src.options import Options  # noqa: E402
+from src.parse_file import parse_file  # noqa: E402
+from src.translate import translate_to_ast  # noqa: E402
+
+STAGES = ["parse_file", "build_flowgraph", "translate_to_ast", "write_function"]
+
+DEFAULT_SIZES: Dict[str, List[int]] = {
+    "straight_line": [100, 1000, 10000],
+    "nested_ifs": [10, 50, 200],
+    "jump_table": [10, 100, 1000],
+    "nested_loops": [5, 20, 50],
+    "early_returns": [10, 100, 500],
+}
+
+
+def make_options() -> Options:
+    return Options(
+        filename="<bench>",
+        debug=False,
+        void=False,
+        ifs=True,
+        andor_detection=True,
+        goto_patterns=["GOTO"],
+        rodata_files=[],
+        stop_on_error=True,
+        print_assembly=False,
+        visualize_flowgraph=False,
+        preproc_defines={},
+    )
+
+
+def run_stages(asm: str, measure: Callable[[str, Callable[[], Any]], Any]) -> None:
+    """Run each stage once, passing it to measure(stage_name, fn)."""
+    options = make_options()
+    mips_file = measure("parse_file", lambda: parse_file(asm.splitlines(), options))
+    function = mips_file.functions[0]
+    rodata = mips_file.rodata
+    measure("build_flowgraph", lambda: build_flowgraph(function, rodata))
+    function_info = measure(
+        "translate_to_ast", lambda: translate_to_ast(function, options, rodata)
+    )
+    with contextlib.redirect_stdout(io.StringIO()):
+        measure("write_function", lambda: write_function(function_info, options))
+
+
+def time_stages(asm: str, repeat: int) -> Dict[str, float]:
+    """Median time of each stage over several runs."""
+    times: Dict[str, List[float]] = {stage: [] for stage in STAGES}
+
+    def measure(stage: str, fn: Callable[[], Any]) -> Any:
+        start = time.perf_counter()
+        ret = fn()
+        times[stage].append(time.perf_counter() - start)
+        return ret
+
+    for _ in range(repeat):
+        gc.collect()
+        run_stages(asm, measure)
+    return {stage: statistics.median(t) for stage, t in times.items()}
+
+
+def peak_memory_stages(asm: str) -> Dict[str, int]:
+    """Peak memory allocated during each stage, in bytes. This is measured
+    separately from time, since tracing allocations slows everything down."""
+    peaks: Dict[str, int] = {}
+
+    def measure(stage: str, fn: Callable[[], Any]) -> Any:
+        tracemalloc.start()
+        try:
+            ret = fn()
+            peaks[stage] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        return ret
+
+    run_stages(asm, measure)
+    return peaks
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=Path(__file__).resolve().parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(
+    kinds: List[str], sizes: Optional[List[int]], repeat: int
+) -> List[Dict[str, Any]]:
+    results = []
+    for kind in kinds:
+        for size in sizes or DEFAULT_SIZES[kind]:
+            asm = generate(kind, size)
+            try:
+                times = time_stages(asm, repeat)
+                peaks = peak_memory_stages(asm)
+            except Exception as e:
+                # Failures are results too: they show where the decompiler
+                # stops scaling.
+                error = f"{type(e).__name__}: {e}".splitlines()[0]
+                results.append({"kind": kind, "size": size, "error": error})
+                print(f"{kind:>14} {size:>6} FAILED: {error}")
+                continue
+            for stage in STAGES:
+                results.append(
+                    {
+                        "kind": kind,
+                        "size": size,
+                        "stage": stage,
+                        "time": times[stage],
+                        "peak_memory": peaks[stage],
+                    }
+                )
+            print_results(results[-len(STAGES) :])
+    return results
+
+
+def print_results(results: List[Dict[str, Any]]) -> None:
+    for r in results:
+        print(
+            f"{r['kind']:>14} {r['size']:>6} {r['stage']:>17} "
+            f"{r['time'] * 1000:>10.2f}ms {r['peak_memory'] / 1024:>10.1f}KiB"
+        )
+    sys.stdout.flush()
+
+
+def compare(old_path: Path, new_path: Path) -> int:
+    """Print how the results in new_path compare to those in old_path."""
+    old = json.loads(old_path.read_text())
+    new = json.loads(new_path.read_text())
+    print(f"old: {old.get('revision')}, new: {new.get('revision')}")
+    old_results = {(r["kind"], r["size"], r.get("stage")): r for r in old["results"]}
+    for r in new["results"]:
+        o = old_results.get((r["kind"], r["size"], r.get("stage")))
+        if o is None:
+            continue
+        if "error" in r or "error" in o:
+            print(
+                f"{r['kind']:>14} {r['size']:>6} "
+                f"{o.get('error', 'ok')} -> {r.get('error', 'ok')}"
+            )
+            continue
+        time_ratio = r["time"] / o["time"] if o["time"] else float("inf")
+        mem_ratio = r["peak_memory"] / o["peak_memory"] if o["peak_memory"] else 1.0
+        print(
+            f"{r['kind']:>14} {r['size']:>6} {r['stage']:>17} "
+            f"time {o['time'] * 1000:>9.2f}ms -> {r['time'] * 1000:>9.2f}ms "
+            f"({time_ratio:>5.2f}x)  memory {mem_ratio:>5.2f}x"
+        )
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--kind",
+        dest="kinds",
+        action="append",
+        choices=sorted(GENERATORS),
+        help="kind of function to benchmark; may be given several times. "
+        "Default: all kinds",
+    )
+    parser.add_argument(
+        "--size",
+        dest="sizes",
+        type=int,
+        action="append",
+        help="function size to benchmark; may be given several times. "
+        "Default: a few sizes depending on the kind",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="number of timed runs per benchmark; the median is reported",
+    )
+    parser.add_argument(
+        "--save", metavar="JSON_FILE", type=Path, help="write results to this file"
+    )
+    parser.add_argument(
+        "--compare",
+        metavar="JSON_FILE",
+        type=Path,
+        nargs=2,
+        help="instead of running benchmarks, compare two saved results",
+    )
+    args = parser.parse_args()
+
+    if args.compare:
+        return compare(*args.compare)
+
+    results = run_benchmarks(args.kinds or list(GENERATORS), args.sizes, args.repeat)
+    if args.save:
+        args.save.write_text(
+            json.dumps({"revision": git_revision(), "results": results}, indent=2)
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
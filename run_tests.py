@@ -1,16 +1,36 @@
 #!/usr/bin/env python3
 import argparse
+import collections
+import concurrent.futures
 import contextlib
 import difflib
+import hashlib
 import io
+import json
 import logging
+import os
+import statistics
+import subprocess
 import sys
+import tempfile
+import time
+import tracemalloc
 from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
 
+import attr
+
+from src.atomic_write import atomic_write
+from src.incremental import source_hash
 from src.main import run as decompile
 from src.options import Options
 
 CRASH_STRING = "CRASHED\n"
+CACHE_FILE = ".run_tests_cache.json"
+
+# Number of synthetic functions decompiled by --streaming-memory, first to get
+# a baseline, and then to check that memory use stays the same.
+STREAMING_FUNCTION_COUNTS = (100, 10000)
 
 
 def set_up_logging(debug: bool) -> None:
@@ -20,75 +40,379 @@ def set_up_logging(debug: bool) -> None:
     )
 
 
-def decompile_and_compare(
-    asm_file_path: Path, output_path: Path, should_overwrite: bool
-) -> None:
+@attr.s
+class TestCase:
+    asm_file_path: Path = attr.ib()
+    output_path: Path = attr.ib()
+
+    @property
+    def name(self) -> str:
+        return f"{self.asm_file_path.parent.name}/{self.asm_file_path.name}"
+
+    @property
+    def perf_path(self) -> Path:
+        return self.asm_file_path.parent.joinpath(
+            self.asm_file_path.stem + "-perf.json"
+        )
+
+
+@attr.s
+class PerfSettings:
+    # Number of timed runs per test case; the median is used.
+    repeat: int = attr.ib()
+    # How much slower than the baseline a test case may get, as a fraction.
+    threshold: float = attr.ib()
+    # Whether to write the measurements as the new baselines.
+    save: bool = attr.ib()
+
+
+@attr.s
+class Measurement:
+    # Median wall time of a decompilation, in seconds.
+    time: float = attr.ib()
+    # Peak memory allocated during a decompilation, in bytes.
+    peak_memory: int = attr.ib()
+
+
+@attr.s
+class TestResult:
+    case: TestCase = attr.ib()
+    # One of "passed", "changed", "slower" or "cached".
+    status: str = attr.ib()
+    elapsed: float = attr.ib(default=0.0)
+    measurement: Optional[Measurement] = attr.ib(default=None)
+
+
+def file_hash(path: Path) -> str:
+    try:
+        return hashlib.sha1(path.read_bytes()).hexdigest()
+    except FileNotFoundError:
+        return ""
+
+
+def cache_key(case: TestCase, src_hash: str) -> str:
+    return ":".join(
+        [file_hash(case.asm_file_path), file_hash(case.output_path), src_hash]
+    )
+
+
+def load_cache(path: Path) -> Dict[str, str]:
+    try:
+        cache: Dict[str, str] = json.loads(path.read_text())
+        return cache
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(path: Path, cache: Dict[str, str]) -> None:
+    with atomic_write(path) as f:
+        f.write(json.dumps(cache, indent=1, sort_keys=True))
+
+
+def run_case(
+    case: TestCase, perf: Optional[PerfSettings]
+) -> Tuple[str, float, Optional[Measurement]]:
+    """Decompile a test case, returning the output and the time it took. If
+    perf is given, it is then decompiled again to measure its performance."""
+    start = time.perf_counter()
+    final_contents = decompile_and_capture_output(case.output_path, case.asm_file_path)
+    elapsed = time.perf_counter() - start
+    if perf is None:
+        return final_contents, elapsed, None
+
+    times = []
+    for _ in range(perf.repeat):
+        start = time.perf_counter()
+        decompile_and_capture_output(case.output_path, case.asm_file_path)
+        times.append(time.perf_counter() - start)
+    # Tracing allocations slows everything down, so memory gets its own run.
+    tracemalloc.start()
+    try:
+        decompile_and_capture_output(case.output_path, case.asm_file_path)
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return final_contents, elapsed, Measurement(statistics.median(times), peak_memory)
+
+
+def check_perf(case: TestCase, measurement: Measurement, perf: PerfSettings) -> bool:
+    """Compare a measurement against the baseline of a test case, and return
+    whether it got slower, or needs more memory, by more than the threshold."""
+    regressed = False
+    try:
+        baseline = Measurement(**json.loads(case.perf_path.read_text()))
+    except FileNotFoundError:
+        logging.debug(f"{case.perf_path} does not exist.")
+    else:
+        for what, old, new, unit, scale in [
+            ("time", baseline.time, measurement.time, "ms", 1000),
+            (
+                "peak memory",
+                baseline.peak_memory,
+                measurement.peak_memory,
+                "KiB",
+                1 / 1024,
+            ),
+        ]:
+            if new > old * (1 + perf.threshold):
+                logging.info(
+                    f"{case.name} regressed: {what} went from "
+                    f"{old * scale:.2f}{unit} to {new * scale:.2f}{unit} "
+                    f"({(new / old - 1) * 100 if old else float('inf'):+.0f}%)"
+                )
+                regressed = True
+
+    if perf.save:
+        case.perf_path.write_text(
+            json.dumps(attr.asdict(measurement), indent=2, sort_keys=True) + "\n"
+        )
+    return regressed
+
+
+def compare_output(
+    case: TestCase,
+    final_contents: str,
+    elapsed: float,
+    measurement: Optional[Measurement],
+    should_overwrite: bool,
+    perf: Optional[PerfSettings],
+) -> TestResult:
     logging.debug(
-        f"Decompiling {asm_file_path}"
-        + (f" into {output_path}" if should_overwrite else "")
+        f"Decompiled {case.asm_file_path}"
+        + (f" into {case.output_path}" if should_overwrite else "")
     )
     try:
-        original_contents = output_path.read_text()
+        original_contents = case.output_path.read_text()
     except FileNotFoundError:
-        logging.info(f"{output_path} does not exist. Creating...")
+        logging.info(f"{case.output_path} does not exist. Creating...")
         original_contents = "(file did not exist)"
 
-    final_contents = decompile_and_capture_output(output_path, asm_file_path)
-
     if should_overwrite:
-        output_path.write_text(final_contents)
+        case.output_path.write_text(final_contents)
 
     changed = final_contents != original_contents
     if changed:
         logging.info(
             "\n".join(
                 [
-                    f"Output of {asm_file_path} changed! Diff:",
+                    f"Output of {case.asm_file_path} changed! Diff:",
                     *difflib.unified_diff(
                         original_contents.splitlines(), final_contents.splitlines()
                     ),
                 ]
             )
         )
+    if changed:
+        status = "changed"
+    elif perf is not None and measurement is not None:
+        status = "slower" if check_perf(case, measurement, perf) else "passed"
+    else:
+        status = "passed"
+    return TestResult(case, status, elapsed, measurement)
 
 
 def decompile_and_capture_output(output_path: Path, asm_file_path: Path) -> str:
     out_string = io.StringIO()
     with contextlib.redirect_stdout(out_string):
-        returncode = decompile(
-            Options(
-                filename=str(asm_file_path),
-                debug=False,
-                void=False,
-                ifs=True,
-                andor_detection=True,
-                goto_patterns=["GOTO"],
-                rodata_files=[],
-                stop_on_error=True,
-                print_assembly=False,
-                visualize_flowgraph=False,
-                preproc_defines={},
-            ),
-            "test",
-        )
+        returncode = decompile(case_options(asm_file_path), "test")
     if returncode == 0:
         return out_string.getvalue()
     else:
         return CRASH_STRING
 
 
-def run_e2e_test(e2e_test_path: Path, should_overwrite: bool) -> None:
-    logging.info(f"Running test: {e2e_test_path.name}")
+def case_options(asm_file_path: Path) -> Options:
+    return Options(
+        filename=str(asm_file_path),
+        debug=False,
+        void=False,
+        ifs=True,
+        andor_detection=True,
+        goto_patterns=["GOTO"],
+        rodata_files=[],
+        stop_on_error=True,
+        print_assembly=False,
+        visualize_flowgraph=False,
+        preproc_defines={},
+    )
 
-    for asm_file_path in e2e_test_path.glob("*.s"):
-        old_output_path = asm_file_path.parent.joinpath(asm_file_path.stem + "-out.c")
-        decompile_and_compare(asm_file_path, old_output_path, should_overwrite)
 
+def check_parse_error() -> bool:
+    """Check that an exception raised while parsing reaches the caller as is,
+    rather than being replaced by one from closing the input file."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        asm_file_path = Path(tmp_dir) / "parse_error.s"
+        asm_file_path.write_text("glabel test\n    bogusinstr $t0, ((\n    jr $ra\n")
+        try:
+            with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(
+                io.StringIO()
+            ):
+                decompile(case_options(asm_file_path), "test")
+        except BufferError as e:
+            logging.info(f"Parse error was replaced by BufferError: {e}")
+            return False
+        except Exception:
+            return True
+    logging.info("Parsing an invalid instruction did not raise.")
+    return False
 
-def main(should_overwrite: bool) -> int:
-    for e2e_test_path in (Path(__file__).parent / "tests" / "end_to_end").iterdir():
-        run_e2e_test(e2e_test_path, should_overwrite)
 
+def find_test_cases() -> List[TestCase]:
+    cases = []
+    for e2e_test_path in sorted(
+        (Path(__file__).parent / "tests" / "end_to_end").iterdir()
+    ):
+        for asm_file_path in sorted(e2e_test_path.glob("*.s")):
+            output_path = asm_file_path.parent.joinpath(asm_file_path.stem + "-out.c")
+            cases.append(TestCase(asm_file_path, output_path))
+    return cases
+
+
+def run_cases(
+    cases: List[TestCase],
+    jobs: int,
+    should_overwrite: bool,
+    perf: Optional[PerfSettings],
+) -> Iterator[TestResult]:
+    """Run test cases across a pool of worker processes, yielding results as
+    they become available."""
+    if jobs == 1:
+        for case in cases:
+            yield compare_output(case, *run_case(case, perf), should_overwrite, perf)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(run_case, case, perf): case for case in cases}
+        for future in concurrent.futures.as_completed(futures):
+            yield compare_output(
+                futures[future], *future.result(), should_overwrite, perf
+            )
+
+
+def print_summary(results: List[TestResult], total_elapsed: float) -> None:
+    for result in sorted(results, key=lambda r: (-r.elapsed, r.case.name)):
+        m = result.measurement
+        if result.status == "cached":
+            logging.debug(f"{result.case.name}: cached")
+        elif m is not None:
+            logging.info(
+                f"{result.case.name}: {result.status} in {result.elapsed * 1000:.1f}ms"
+                f" (median {m.time * 1000:.2f}ms, "
+                f"peak memory {m.peak_memory / 1024:.1f}KiB)"
+            )
+        else:
+            logging.info(
+                f"{result.case.name}: {result.status} in {result.elapsed * 1000:.1f}ms"
+            )
+    counts = collections.Counter(r.status for r in results)
+    logging.info(
+        f"{len(results)} test cases in {total_elapsed:.2f}s: "
+        + ", ".join(
+            f"{counts[status]} {status}"
+            for status in ["passed", "changed", "slower", "cached"]
+        )
+    )
+
+
+def main(
+    should_overwrite: bool, jobs: int, use_cache: bool, perf: Optional[PerfSettings]
+) -> int:
+    start = time.perf_counter()
+    cases = find_test_cases()
+    cache_path = Path(__file__).parent / CACHE_FILE
+    cache = load_cache(cache_path) if use_cache else {}
+    src_hash = source_hash()
+
+    results: List[TestResult] = []
+    to_run: List[TestCase] = []
+    for case in cases:
+        # Skip cases which passed last time, if neither the input, the expected
+        # output nor the decompiler has changed since.
+        # Performance is always measured from scratch.
+        if (
+            use_cache
+            and not should_overwrite
+            and perf is None
+            and cache.get(case.name) == cache_key(case, src_hash)
+        ):
+            results.append(TestResult(case, "cached"))
+        else:
+            to_run.append(case)
+
+    for result in run_cases(to_run, jobs, should_overwrite, perf):
+        results.append(result)
+        if result.status in ("passed", "slower") or should_overwrite:
+            cache[result.case.name] = cache_key(result.case, src_hash)
+        else:
+            cache.pop(result.case.name, None)
+
+    if use_cache:
+        save_cache(cache_path, cache)
+    print_summary(results, time.perf_counter() - start)
+    if any(r.status == "slower" for r in results):
+        return 1
+    if not check_parse_error():
+        return 1
+    return 0
+
+
+def run_for_peak_rss(args: List[str]) -> int:
+    """Run a command, and return the peak resident set size of its process."""
+    with open(os.devnull, "w") as devnull:
+        proc = subprocess.Popen(args, stdout=devnull)
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, args)
+    # This is in kilobytes, except on macOS, where it is in bytes.
+    return rusage.ru_maxrss if sys.platform == "darwin" else rusage.ru_maxrss * 1024
+
+
+def check_streaming_memory(max_growth: float) -> int:
+    """Decompile synthetic files with few and with many functions with 'all',
+    each in a fresh process, and check that peak memory use does not grow
+    with the number of functions."""
+    root = Path(__file__).parent
+    peaks = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for count in STREAMING_FUNCTION_COUNTS:
+            # Generate the input in a separate process too, since a process
+            # started from a large one can be charged for its memory.
+            asm_file_path = Path(tmp_dir) / f"straight_line_{count}.s"
+            with asm_file_path.open("w") as f:
+                subprocess.run(
+                    [
+                        sys.executable,
+                        str(root / "bench" / "generate.py"),
+                        "straight_line",
+                        "20",
+                        f"--count={count}",
+                    ],
+                    stdout=f,
+                    check=True,
+                )
+            start = time.perf_counter()
+            peaks.append(
+                run_for_peak_rss(
+                    [
+                        sys.executable,
+                        str(root / "mips_to_c.py"),
+                        str(asm_file_path),
+                        "all",
+                    ]
+                )
+            )
+            logging.info(
+                f"{count} functions: peak RSS {peaks[-1] / 2**20:.1f}MiB "
+                f"in {time.perf_counter() - start:.1f}s"
+            )
+    growth = peaks[-1] / peaks[0]
+    if growth > max_growth:
+        logging.info(
+            f"Peak RSS grew {growth:.2f}x with {STREAMING_FUNCTION_COUNTS[-1]} "
+            f"functions, more than the allowed {max_growth:.2f}x."
+        )
+        return 1
     return 0
 
 
@@ -108,9 +432,79 @@ if __name__ == "__main__":
             "Do this once before committing."
         ),
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        dest="jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of test cases to run in parallel. Default: number of CPUs",
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="use_cache",
+        action="store_false",
+        help=f"run all test cases, instead of skipping the ones that passed "
+        f"last time and have not changed since (as recorded in {CACHE_FILE})",
+    )
+    parser.add_argument(
+        "--perf",
+        dest="perf",
+        action="store_true",
+        help="measure the time and peak memory of each test case, and fail if "
+        "they got worse than the baseline in the *-perf.json file next to its "
+        "expected output. Timings are most reliable with -j 1",
+    )
+    parser.add_argument(
+        "--perf-repeat",
+        dest="perf_repeat",
+        metavar="N",
+        type=int,
+        default=5,
+        help="number of timed runs per test case with --perf; the median is "
+        "used. Default: 5",
+    )
+    parser.add_argument(
+        "--perf-threshold",
+        dest="perf_threshold",
+        metavar="PERCENT",
+        type=float,
+        default=20.0,
+        help="how much worse than the baseline a test case may get with --perf. "
+        "Default: 20",
+    )
+    parser.add_argument(
+        "--perf-save",
+        dest="perf_save",
+        action="store_true",
+        help="with --perf, write the measurements as new baselines. Baselines "
+        "depend on the machine, and are not checked in",
+    )
+    parser.add_argument(
+        "--streaming-memory",
+        dest="streaming_memory",
+        metavar="MAX_GROWTH",
+        type=float,
+        nargs="?",
+        const=2.0,
+        help="instead of running the test cases, check that the peak memory "
+        f"of 'all' on {STREAMING_FUNCTION_COUNTS[-1]} synthetic functions is "
+        f"at most MAX_GROWTH times that on {STREAMING_FUNCTION_COUNTS[0]}. "
+        "This takes a few minutes. Default: 2",
+    )
     args = parser.parse_args()
     set_up_logging(args.debug)
 
+    if args.streaming_memory is not None:
+        sys.exit(check_streaming_memory(args.streaming_memory))
+
     if args.should_overwrite:
         logging.info("Overwriting test output files.")
-    sys.exit(main(args.should_overwrite))
+    perf = None
+    if args.perf or args.perf_save:
+        perf = PerfSettings(
+            repeat=max(args.perf_repeat, 1),
+            threshold=args.perf_threshold / 100,
+            save=args.perf_save,
+        )
+    sys.exit(main(args.should_overwrite, args.jobs, args.use_cache, perf))
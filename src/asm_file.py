@@ -0,0 +1,84 @@
+import mmap
+import re
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Union
+
+import attr
+
+# Lines with something other than whitespace or a "#" comment on them. Other
+# lines never affect parsing, so they are skipped without being decoded.
+CONTENT_LINE_RE = re.compile(rb"^[^\S\n]*([^\s#].*)", re.MULTILINE)
+
+# Lines which may start a new function or change the current section. This is
+# an over-approximation: the parser decides what these lines actually mean.
+BOUNDARY_RE = re.compile(
+    rb"^[ \t]*(?:"
+    rb"glabel[ \t]+([^\s#]+)"
+    rb"|(func[^\s:#]*):"
+    rb"|\.(section|text|rdata|rodata|late_rodata|data|bss)\b"
+    rb")",
+    re.MULTILINE,
+)
+
+
+@attr.s
+class Boundary:
+    offset: int = attr.ib()
+    # Either "glabel", "label" (for "func_XXX:" style function labels) or
+    # "section".
+    kind: str = attr.ib()
+    name: str = attr.ib()
+
+
+@attr.s
+class AsmFile:
+    """An assembly file mapped into memory and read as bytes. Lines are only
+    decoded when handed to the parser, and offsets into the file can be used
+    to read parts of it."""
+
+    filename: str = attr.ib()
+    data: Union[mmap.mmap, bytes] = attr.ib(repr=False)
+
+    def lines(self, start: int = 0, end: Optional[int] = None) -> Iterator[str]:
+        """Decode the lines of the file between two byte offsets, skipping
+        blank and comment-only lines."""
+        end = len(self.data) if end is None else end
+        for match in CONTENT_LINE_RE.finditer(self.data, start, end):
+            yield match.group(1).decode("utf-8")
+
+    def boundaries(self) -> List[Boundary]:
+        """Find function labels and section directives in the file."""
+        ret: List[Boundary] = []
+        for match in BOUNDARY_RE.finditer(self.data):
+            glabel, label, section = match.groups()
+            if glabel is not None:
+                ret.append(Boundary(match.start(), "glabel", glabel.decode("utf-8")))
+            elif label is not None:
+                ret.append(Boundary(match.start(), "label", label.decode("utf-8")))
+            else:
+                ret.append(Boundary(match.start(), "section", section.decode("utf-8")))
+        return ret
+
+
+@contextmanager
+def open_asm_file(filename: str) -> Iterator[AsmFile]:
+    with open(filename, "rb") as f:
+        try:
+            data: Union[mmap.mmap, bytes] = mmap.mmap(
+                f.fileno(), 0, access=mmap.ACCESS_READ
+            )
+        except (ValueError, OSError):
+            # Empty files and pipes such as /dev/stdin cannot be mapped.
+            data = f.read()
+        try:
+            yield AsmFile(filename, data)
+        finally:
+            if isinstance(data, mmap.mmap):
+                try:
+                    data.close()
+                except BufferError:
+                    # A line iterator is still alive, e.g. because it is
+                    # referenced by the traceback of an exception raised while
+                    # parsing. Leave the mapping to be closed once it is
+                    # garbage collected, rather than hiding that exception.
+                    pass
@@ -0,0 +1,24 @@
+import os
+from contextlib import contextmanager
+from typing import IO, Any, Iterator, Union
+
+
+@contextmanager
+def atomic_write(
+    path: Union[str, "os.PathLike[str]"], mode: str = "w"
+) -> Iterator[IO[Any]]:
+    """Open a temporary file next to path for writing, and replace path with
+    it once the block is done, so that readers (and runs that are
+    interrupted) never see a partly written file. If the block raises, path
+    is left as it was."""
+    tmp_path = f"{os.fspath(path)}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
@@ -0,0 +1,449 @@
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+from multiprocessing.connection import Connection
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import attr
+
+from . import profiling
+from .error import DecompFailure
+from .main import decompile_function
+from .options import Options
+from .parse_file import Function, Instruction, Label, Rodata
+from .parse_instruction import Register
+from .profiling import Profiler
+
+# Statuses of a function in a batch run.
+OK = "OK"
+# The decompiler gave up on the function with a DecompFailure.
+FAILED = "FAILED"
+# Any other exception, i.e. a bug in the decompiler.
+ERROR = "ERROR"
+TIMEOUT = "TIMEOUT"
+OOM = "OOM"
+
+# Exit code of a worker process that ran out of memory outside of decompiling.
+OOM_EXIT_CODE = 3
+
+# Weights of the cost model, in seconds per unit of each feature. They were
+# fitted to the end-to-end tests and the functions from bench/generate.py.
+# Structuring control flow makes the cost grow with branches times labels;
+# jump tables did not add anything beyond their labels and branches. Use
+# --cost-report to collect data for tuning them.
+COST_WEIGHTS: Dict[str, float] = {
+    "base": 1.4e-4,
+    "instructions": 7e-5,
+    "branches": 1.5e-4,
+    "branches_x_labels": 1.2e-6,
+    "jump_tables": 0.0,
+}
+
+
+@attr.s
+class BatchResult:
+    name: str = attr.ib()
+    status: str = attr.ib()
+    # The text printed for the function, including the trailing blank line.
+    output: str = attr.ib()
+    error: Optional[str] = attr.ib(default=None)
+    elapsed: float = attr.ib(default=0.0)
+    # Seconds spent in each phase, only collected for --db and --profile.
+    phase_times: Dict[str, float] = attr.ib(factory=dict)
+    # Number of flow graph nodes, only collected for --db.
+    nodes: Optional[int] = attr.ib(default=None)
+
+
+def decompile_to_result(
+    options: Options, function: Function, rodata: Rodata, index: int
+) -> BatchResult:
+    """Decompile a function with the same output as decompile_function_or_error,
+    but keep track of how it went. Timings are returned rather than added to
+    the active profiler, which may be in another process."""
+    status = OK
+    error: Optional[str] = None
+    nodes: Optional[int] = None
+    outer_profiler = profiling.profiler
+    profiler: Optional[Profiler] = None
+    if outer_profiler is not None:
+        profiler = Profiler(
+            hook_function=outer_profiler.hook_function, hook=outer_profiler.hook
+        )
+    elif options.results_db is not None:
+        profiler = Profiler()
+    profiling.profiler = profiler
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()) as f:
+        try:
+            function_info = decompile_function(options, function, rodata, index)
+            if function_info is not None:
+                nodes = len(function_info.flow_graph.nodes)
+        except MemoryError:
+            status, error = OOM, "out of memory"
+            print(f"{function.name}: OOM")
+        except DecompFailure as e:
+            status, error = FAILED, str(e)
+            print(f"{function.name}: ERROR")
+        except Exception as e:
+            status, error = ERROR, f"{type(e).__name__}: {e}"
+            print(f"{function.name}: ERROR")
+        finally:
+            profiling.profiler = outer_profiler
+        print()
+    elapsed = time.perf_counter() - start
+
+    phase_times: Dict[str, float] = {}
+    if profiler is not None:
+        phase_times = profiler.timings.get((index, function.name), {})
+    return BatchResult(
+        function.name, status, f.getvalue(), error, elapsed, phase_times, nodes
+    )
+
+
+@attr.s
+class CostFeatures:
+    instructions: int = attr.ib()
+    labels: int = attr.ib()
+    branches: int = attr.ib()
+    jump_tables: int = attr.ib()
+
+    def predict(self) -> float:
+        """Estimate how many seconds decompiling the function will take."""
+        w = COST_WEIGHTS
+        return (
+            w["base"]
+            + w["instructions"] * self.instructions
+            + w["branches"] * self.branches
+            + w["branches_x_labels"] * self.branches * self.labels
+            + w["jump_tables"] * self.jump_tables
+        )
+
+
+def cost_features(function: Function) -> CostFeatures:
+    instructions = labels = branches = jump_tables = 0
+    for item in function.body:
+        if isinstance(item, Label):
+            labels += 1
+            continue
+        instructions += 1
+        if item.is_branch_instruction():
+            branches += 1
+        elif item.mnemonic == "jr" and item.args[0] != Register("ra"):
+            jump_tables += 1
+    return CostFeatures(instructions, labels, branches, jump_tables)
+
+
+@attr.s
+class BatchTask:
+    """A function to decompile as part of a batch, with its index in the
+    input."""
+
+    index: int = attr.ib()
+    function: Function = attr.ib()
+    # Hash of the function for --incremental and --result-cache.
+    fn_hash: str = attr.ib(default="")
+    # Output reused from an earlier run, in which case it is not decompiled.
+    output: Optional[str] = attr.ib(default=None)
+    result: Optional[BatchResult] = attr.ib(default=None)
+
+
+def marker_result(
+    function: Function, status: str, error: str, elapsed: float
+) -> BatchResult:
+    output = f"{function.name}: {status}\n\n"
+    return BatchResult(function.name, status, output, error, elapsed)
+
+
+def limit_memory(limit: int) -> None:
+    """Limit the address space of the current process to what it uses now,
+    plus the given number of bytes."""
+    try:
+        import resource
+    except ImportError:
+        print("Warning: --memory-limit is not supported here.", file=sys.stderr)
+        return
+    current = 0
+    try:
+        with open("/proc/self/statm") as f:
+            current = int(f.read().split()[0]) * resource.getpagesize()
+    except (OSError, ValueError):
+        pass
+    resource.setrlimit(resource.RLIMIT_AS, (current + limit, current + limit))
+
+
+def worker_main(
+    conn: Connection,
+    options: Options,
+    rodata: Rodata,
+    memory_limit: Optional[int],
+    profiler: Optional[Profiler],
+) -> None:
+    # The parent handles interrupts, and kills us if needed.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if memory_limit is not None:
+        limit_memory(memory_limit)
+    # Timings are sent back with each result, and merged by the parent.
+    profiling.profiler = profiler
+    try:
+        while True:
+            item = conn.recv()
+            if item is None:
+                return
+            index, function = item
+            conn.send(decompile_to_result(options, function, rodata, index))
+    except MemoryError:
+        os._exit(OOM_EXIT_CODE)
+
+
+def worker_context() -> Any:
+    """Workers are started from several threads with --jobs, and forking a
+    process with several threads can leave locks held in the child. Start
+    them from a single-threaded fork server instead, or from scratch where
+    that is not available."""
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context("forkserver")
+        # Have the fork server import the decompiler once, rather than every
+        # worker doing so.
+        ctx.set_forkserver_preload([__name__])
+        return ctx
+    return multiprocessing.get_context("spawn")
+
+
+@attr.s
+class IsolatedWorker:
+    """A worker process that decompiles one function at a time. It is killed
+    and replaced when a function takes too long, or when it dies, so that a
+    single function cannot stall or bring down a whole batch."""
+
+    options: Options = attr.ib()
+    rodata: Rodata = attr.ib()
+    timeout: Optional[float] = attr.ib()
+    memory_limit: Optional[int] = attr.ib()
+    process: Optional[Any] = attr.ib(default=None)
+    conn: Optional[Connection] = attr.ib(default=None)
+
+    def start(self) -> Connection:
+        ctx = worker_context()
+        pipe: Tuple[Connection, Connection] = ctx.Pipe()
+        conn, child_conn = pipe
+        # Only the settings of the profiler are needed in the worker.
+        prof = profiling.profiler
+        worker_profiler = (
+            Profiler(hook_function=prof.hook_function, hook=prof.hook)
+            if prof is not None
+            else None
+        )
+        self.process = ctx.Process(
+            target=worker_main,
+            args=(
+                child_conn,
+                self.options,
+                self.rodata,
+                self.memory_limit,
+                worker_profiler,
+            ),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        self.conn = conn
+        return conn
+
+    def kill(self) -> None:
+        if self.process is not None:
+            self.process.kill()
+            self.process.join()
+        if self.conn is not None:
+            self.conn.close()
+        self.process = None
+        self.conn = None
+
+    def run(self, index: int, function: Function) -> BatchResult:
+        conn = self.conn or self.start()
+        start = time.perf_counter()
+        try:
+            conn.send((index, function))
+            finished = conn.poll(self.timeout)
+            if finished:
+                result: BatchResult = conn.recv()
+                if result.status == OOM:
+                    # Memory may not be given back to the system, so start
+                    # over with a fresh process.
+                    self.kill()
+                return result
+        except (EOFError, OSError):
+            # The worker died; find out why below.
+            finished = True
+        elapsed = time.perf_counter() - start
+
+        if not finished:
+            self.kill()
+            error = f"took longer than {self.timeout} seconds"
+            return marker_result(function, TIMEOUT, error, elapsed)
+
+        assert self.process is not None
+        self.process.join()
+        exitcode = self.process.exitcode
+        self.kill()
+        if exitcode in (OOM_EXIT_CODE, -signal.SIGKILL):
+            # SIGKILL most likely came from the system's out-of-memory killer.
+            return marker_result(function, OOM, "worker was killed", elapsed)
+        error = f"worker exited with code {exitcode}"
+        return marker_result(function, ERROR, error, elapsed)
+
+    def close(self) -> None:
+        if self.conn is not None:
+            try:
+                self.conn.send(None)
+            except OSError:
+                pass
+        if self.process is not None:
+            self.process.join(1)
+        self.kill()
+
+
+@contextlib.contextmanager
+def isolated_worker(options: Options, rodata: Rodata) -> Iterator[IsolatedWorker]:
+    worker = IsolatedWorker(options, rodata, options.timeout, options.memory_limit)
+    try:
+        yield worker
+    finally:
+        worker.close()
+
+
+def merge_phase_times(task: BatchTask) -> None:
+    prof = profiling.profiler
+    if prof is not None and task.result is not None:
+        prof.merge((task.index, task.function.name), task.result.phase_times)
+
+
+def run_tasks(
+    options: Options,
+    rodata: Rodata,
+    tasks: Iterable[BatchTask],
+    on_done: Optional[Callable[[BatchTask], None]] = None,
+) -> Iterator[BatchTask]:
+    """Decompile the functions of all tasks without output, and yield the
+    tasks in order as they finish. on_done is called for each decompiled
+    task as soon as it finishes, which may be before the tasks in front of
+    it. With several jobs, all tasks are read up front so that the most
+    expensive ones can be started first."""
+    if options.jobs > 1:
+        yield from run_tasks_parallel(options, rodata, list(tasks), on_done)
+        return
+
+    isolate = options.timeout is not None or options.memory_limit is not None
+    report: List[Tuple[CostFeatures, BatchResult]] = []
+    with contextlib.ExitStack() as stack:
+        worker = (
+            stack.enter_context(isolated_worker(options, rodata)) if isolate else None
+        )
+        for task in tasks:
+            if task.output is None:
+                if worker is not None:
+                    task.result = worker.run(task.index, task.function)
+                else:
+                    task.result = decompile_to_result(
+                        options, task.function, rodata, task.index
+                    )
+                merge_phase_times(task)
+                if on_done is not None:
+                    on_done(task)
+                if options.cost_report is not None:
+                    # Don't hold on to the output of every function.
+                    result = attr.evolve(task.result, output="")
+                    report.append((cost_features(task.function), result))
+            yield task
+    if options.cost_report is not None:
+        write_cost_report(options.cost_report, report)
+
+
+def run_tasks_parallel(
+    options: Options,
+    rodata: Rodata,
+    tasks: List[BatchTask],
+    on_done: Optional[Callable[[BatchTask], None]],
+) -> Iterator[BatchTask]:
+    todo = [task for task in tasks if task.output is None]
+    costs = {task.index: cost_features(task.function) for task in todo}
+    # Longest first, so that no big function is left running on its own at
+    # the end. Ties keep the input order.
+    todo.sort(key=lambda task: -costs[task.index].predict())
+    pending: "queue.Queue[BatchTask]" = queue.Queue()
+    for task in todo:
+        pending.put(task)
+    finished: "queue.Queue[BatchTask]" = queue.Queue()
+
+    def work() -> None:
+        with isolated_worker(options, rodata) as worker:
+            while True:
+                try:
+                    task = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    task.result = worker.run(task.index, task.function)
+                except Exception as e:
+                    error = f"{type(e).__name__}: {e}"
+                    task.result = marker_result(task.function, ERROR, error, 0.0)
+                finished.put(task)
+
+    start = time.perf_counter()
+    threads = [
+        threading.Thread(target=work, daemon=True)
+        for _ in range(min(options.jobs, len(todo)))
+    ]
+    for thread in threads:
+        thread.start()
+    finished_indices: Set[int] = set()
+    for task in tasks:
+        while task.output is None and task.index not in finished_indices:
+            done = finished.get()
+            finished_indices.add(done.index)
+            merge_phase_times(done)
+            if on_done is not None:
+                on_done(done)
+        yield task
+    for thread in threads:
+        thread.join()
+    wall_time = time.perf_counter() - start
+
+    results = [(costs[task.index], task.result) for task in todo if task.result]
+    if options.cost_report is not None:
+        write_cost_report(options.cost_report, results)
+    if options.debug:
+        predicted = sum(cost.predict() for cost, _ in results)
+        actual = sum(result.elapsed for _, result in results)
+        print(
+            f"Scheduler: decompiled {len(todo)} functions with {options.jobs} "
+            f"jobs in {wall_time:.2f}s; predicted {predicted:.2f}s of work, "
+            f"actual {actual:.2f}s.",
+            file=sys.stderr,
+        )
+
+
+def write_cost_report(
+    filename: str, results: List[Tuple[CostFeatures, BatchResult]]
+) -> None:
+    """Write the predicted and actual time of each decompiled function, with
+    the features of the cost model, as JSON."""
+    entries: List[Dict[str, Any]] = []
+    for cost, result in results:
+        entries.append(
+            {
+                "name": result.name,
+                "status": result.status,
+                **attr.asdict(cost),
+                "predicted": cost.predict(),
+                "actual": result.elapsed,
+            }
+        )
+    with open(filename, "w") as f:
+        json.dump({"weights": COST_WEIGHTS, "functions": entries}, f, indent=2)
@@ -1,3 +1,4 @@
+import collections
 import copy
 import typing
 from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple, Union
@@ -16,6 +17,7 @@ from .parse_instruction import (
     Register,
     parse_instruction,
 )
+from .profiling import profiled
 
 
 @attr.s(cmp=False)
@@ -395,6 +397,7 @@ def simplify_standard_patterns(function: Function) -> Function:
     return new_function
 
 
+@profiled("build_blocks")
 def build_blocks(function: Function) -> List[Block]:
     function = normalize_likely_branches(function)
     function = prune_unreferenced_labels(function)
@@ -581,21 +584,21 @@ Node = Union[BasicNode, ConditionalNode, ReturnNode, SwitchNode]
 
 
 def build_graph_from_block(
-    block: Block, blocks: List[Block], nodes: List[Node], rodata: Rodata
+    block: Block,
+    blocks: List[Block],
+    labels: Dict[str, Block],
+    nodes: Dict[Block, Node],
+    rodata: Rodata,
 ) -> Node:
     # Don't reanalyze blocks.
-    for node in nodes:
-        if node.block == block:
-            return node
+    if block in nodes:
+        return nodes[block]
 
     new_node: Node
     dummy_node: Any = None
 
-    def find_block_by_label(label: str) -> Optional[Block]:
-        for block in blocks:
-            if block.label and block.label.name == label:
-                return block
-        return None
+    def build_from(block: Block) -> Node:
+        return build_graph_from_block(block, blocks, labels, nodes, rodata)
 
     # Extract branching instructions from this block.
     jumps: List[Instruction] = [
@@ -606,11 +609,11 @@ def build_graph_from_block(
     if len(jumps) == 0:
         # No jumps, i.e. the next block is this node's successor block.
         new_node = BasicNode(block, False, dummy_node)
-        nodes.append(new_node)
+        nodes[block] = new_node
 
         # Recursively analyze.
         next_block = blocks[block.index + 1]
-        new_node.successor = build_graph_from_block(next_block, blocks, nodes, rodata)
+        new_node.successor = build_from(next_block)
 
         # Keep track of parents.
         new_node.successor.add_parent(new_node)
@@ -624,12 +627,12 @@ def build_graph_from_block(
 
         if jump.mnemonic == "jr" and jump.args[0] == Register("ra"):
             new_node = ReturnNode(block, False, index=0)
-            nodes.append(new_node)
+            nodes[block] = new_node
             return new_node
 
         if jump.mnemonic == "jr":
             new_node = SwitchNode(block, True, [])
-            nodes.append(new_node)
+            nodes[block] = new_node
 
             jtbl_names = []
             for ins in block.instructions:
@@ -648,8 +651,8 @@ def build_graph_from_block(
                     'the instruction, which has a name starting with "jtbl".'
                 )
 
-            jtbl_name = jtbl_names[0]
-            if jtbl_name not in rodata.values:
+            jtbl_entries = rodata.jump_table(jtbl_names[0])
+            if jtbl_entries is None:
                 raise DecompFailure(
                     "Found jr instruction, but the corresponding jump table is not provided.\n\n"
                     "Please pass a --rodata flag to mips_to_c, pointing to the right .s file.\n\n"
@@ -657,15 +660,11 @@ def build_graph_from_block(
                     "to get correct control flow for non-jtbl switch jumps.)"
                 )
 
-            jtbl_entries = rodata.values[jtbl_name]
             for entry in jtbl_entries:
-                if entry == "0":
-                    # We have entered padding, stop reading.
-                    break
-                case_block = find_block_by_label(entry)
+                case_block = labels.get(entry)
                 if case_block is None:
                     raise DecompFailure(f"Cannot find jtbl target {entry}")
-                case_node = build_graph_from_block(case_block, blocks, nodes, rodata)
+                case_node = build_from(case_block)
                 new_node.cases.append(case_node)
                 if new_node not in case_node.parents:
                     case_node.add_parent(new_node)
@@ -676,7 +675,7 @@ def build_graph_from_block(
 
         # Get the block associated with the jump target.
         branch_label = jump.get_branch_target()
-        branch_block = find_block_by_label(branch_label.target)
+        branch_block = labels.get(branch_label.target)
         if branch_block is None:
             target = branch_label.target
             raise DecompFailure(f"Cannot find branch target {target}")
@@ -685,26 +684,20 @@ def build_graph_from_block(
         if is_constant_branch:
             # A constant branch becomes a basic edge to our branch target.
             new_node = BasicNode(block, jump.emit_goto, dummy_node)
-            nodes.append(new_node)
+            nodes[block] = new_node
             # Recursively analyze.
-            new_node.successor = build_graph_from_block(
-                branch_block, blocks, nodes, rodata
-            )
+            new_node.successor = build_from(branch_block)
             # Keep track of parents.
             new_node.successor.add_parent(new_node)
         else:
             # A conditional branch means the fallthrough block is the next
             # block if the branch isn't.
             new_node = ConditionalNode(block, jump.emit_goto, dummy_node, dummy_node)
-            nodes.append(new_node)
+            nodes[block] = new_node
             # Recursively analyze this too.
             next_block = blocks[block.index + 1]
-            new_node.conditional_edge = build_graph_from_block(
-                branch_block, blocks, nodes, rodata
-            )
-            new_node.fallthrough_edge = build_graph_from_block(
-                next_block, blocks, nodes, rodata
-            )
+            new_node.conditional_edge = build_from(branch_block)
+            new_node.fallthrough_edge = build_from(next_block)
             # Keep track of parents.
             new_node.conditional_edge.add_parent(new_node)
             new_node.fallthrough_edge.add_parent(new_node)
@@ -725,16 +718,23 @@ def is_trivial_return_block(block: Block) -> bool:
     return True
 
 
+@profiled("build_nodes")
 def build_nodes(function: Function, blocks: List[Block], rodata: Rodata) -> List[Node]:
-    graph: List[Node] = []
+    graph: Dict[Block, Node] = {}
+
+    # Index blocks by label, so that branch and jump table targets can be
+    # looked up directly.
+    labels: Dict[str, Block] = {}
+    for block in blocks:
+        if block.label and block.label.name not in labels:
+            labels[block.label.name] = block
 
     # Traverse through the block tree.
     entry_block = blocks[0]
-    build_graph_from_block(entry_block, blocks, graph, rodata)
+    build_graph_from_block(entry_block, blocks, labels, graph, rodata)
 
     # Sort the nodes by index.
-    graph.sort(key=lambda node: node.block.index)
-    return graph
+    return sorted(graph.values(), key=lambda node: node.block.index)
 
 
 def is_premature_return(node: Node, edge: Node, nodes: List[Node]) -> bool:
@@ -837,6 +837,7 @@ def ensure_fallthrough(nodes: List[Node]) -> None:
             pre.emit_goto = True
 
 
+@profiled("compute_dominators")
 def compute_dominators(nodes: List[Node]) -> None:
     entry = nodes[0]
     entry.dominators = {entry}
@@ -864,9 +865,107 @@ def compute_dominators(nodes: List[Node]) -> None:
         n.immediately_dominates.sort(key=lambda x: x.block.index)
 
 
+def successors(node: Node) -> List[Node]:
+    if isinstance(node, BasicNode):
+        return [node.successor]
+    elif isinstance(node, ConditionalNode):
+        return [node.conditional_edge, node.fallthrough_edge]
+    elif isinstance(node, SwitchNode):
+        return node.cases
+    else:
+        _: ReturnNode = node
+        return []
+
+
+@attr.s
+class LoopInfo:
+    """The back edges of a flow graph and the loop headers they jump to,
+    computed once when the graph is built. Back edges are the backwards
+    jumps identified by is_loop_edge."""
+
+    headers: Set[Node] = attr.ib(factory=set)
+    back_edge_sources: Set[Node] = attr.ib(factory=set)
+
+    def has_back_edge(self, node: Node) -> bool:
+        """Equivalent to node.is_loop(), without recomputing it."""
+        return node in self.back_edge_sources
+
+    def is_header(self, node: Node) -> bool:
+        return node in self.headers
+
+
+def build_loop_info(nodes: List[Node]) -> LoopInfo:
+    loop_info = LoopInfo()
+    for node in nodes:
+        if isinstance(node, SwitchNode):
+            # Jump tables are indirect jumps, never loop edges.
+            continue
+        for edge in successors(node):
+            if is_loop_edge(node, edge):
+                loop_info.back_edge_sources.add(node)
+                loop_info.headers.add(edge)
+    return loop_info
+
+
+@attr.s(cmp=False)
+class SwitchInfo:
+    """Jump table analysis for a SwitchNode, computed once at build time."""
+
+    # Which switch this is within the function, counting from 1, or 0 if the
+    # function only contains one switch.
+    index: int = attr.ib()
+    histogram: typing.Counter[Node] = attr.ib()
+    # The most common jump table target, which is emitted as "default".
+    default: Optional[Node] = attr.ib()
+    # Runs of consecutive jump table entries with the same target, as
+    # (first index, last index, target) triples.
+    case_ranges: List[Tuple[int, int, Node]] = attr.ib()
+
+
+def analyze_switches(nodes: List[Node]) -> Dict[SwitchNode, SwitchInfo]:
+    switch_nodes = [node for node in nodes if isinstance(node, SwitchNode)]
+    switches: Dict[SwitchNode, SwitchInfo] = {}
+    for i, node in enumerate(switch_nodes):
+        histogram = collections.Counter(node.cases)
+        default = histogram.most_common(1)[0][0] if node.cases else None
+        case_ranges: List[Tuple[int, int, Node]] = []
+        for index, target in enumerate(node.cases):
+            if case_ranges and case_ranges[-1][2] == target:
+                case_ranges[-1] = (case_ranges[-1][0], index, target)
+            else:
+                case_ranges.append((index, index, target))
+        switch_index = i + 1 if len(switch_nodes) > 1 else 0
+        switches[node] = SwitchInfo(switch_index, histogram, default, case_ranges)
+    return switches
+
+
 @attr.s(frozen=True)
 class FlowGraph:
     nodes: List[Node] = attr.ib()
+    loop_info: LoopInfo = attr.ib()
+
+    node_positions: Dict[Node, int] = attr.ib()
+    switches: Dict[SwitchNode, SwitchInfo] = attr.ib()
+
+    @loop_info.default
+    def _loop_info(self) -> LoopInfo:
+        return build_loop_info(self.nodes)
+
+    @node_positions.default
+    def _node_positions(self) -> Dict[Node, int]:
+        return {node: i for i, node in enumerate(self.nodes)}
+
+    @switches.default
+    def _switches(self) -> Dict[SwitchNode, SwitchInfo]:
+        return analyze_switches(self.nodes)
+
+    def next_node(self, node: Node) -> Optional[Node]:
+        """Return the node after the given one in block order, i.e. where
+        control would fall through to, if any."""
+        index = self.node_positions[node] + 1
+        if index == len(self.nodes):
+            return None
+        return self.nodes[index]
 
     def entry_node(self) -> Node:
         return self.nodes[0]
@@ -15,6 +15,7 @@ from .flow_graph import (
     SwitchNode,
 )
 from .options import Options
+from .profiling import profiled
 from .translate import (
     BinaryOp,
     BlockInfo,
@@ -37,9 +38,23 @@ class Context:
     is_void: bool = attr.ib(default=True)
     case_nodes: Dict[Node, List[Tuple[int, int]]] = attr.ib(factory=dict)
     goto_nodes: Set[Node] = attr.ib(factory=set)
-    loop_nodes: Set[Node] = attr.ib(factory=set)
     emitted_nodes: Set[Node] = attr.ib(factory=set)
     has_warned: bool = attr.ib(default=False)
+    # Number of nodes visited while looking for postdominators.
+    work: int = attr.ib(default=0)
+
+
+class StructuringBudgetExceeded(Exception):
+    pass
+
+
+def spend_work(context: Context, amount: int) -> None:
+    """Count work done while structuring control flow, and give up once it
+    goes over --structure-budget."""
+    context.work += amount
+    budget = context.options.structure_budget
+    if budget is not None and context.work > budget:
+        raise StructuringBudgetExceeded()
 
 
 @attr.s
@@ -144,7 +159,7 @@ class Body:
 
 
 def label_for_node(context: Context, node: Node) -> str:
-    if node in context.loop_nodes:
+    if context.flow_graph.loop_info.is_header(node):
         return f"loop_{node.block.index}"
     else:
         return f"block_{node.block.index}"
@@ -209,7 +224,7 @@ def build_conditional_subgraph(
         )
     elif start.fallthrough_edge == end:
         if_condition = if_block_info.branch_condition
-        if not start.is_loop():
+        if not context.flow_graph.loop_info.has_back_edge(start):
             # Only an if block, so this is easy.
             # I think this can only happen in the case where the other branch has
             # an early return.
@@ -263,7 +278,7 @@ def end_reachable_without(
             stack.append(node.successor)
         elif isinstance(node, ConditionalNode):
             stack.append(node.fallthrough_edge)
-            if not node.is_loop():
+            if not context.flow_graph.loop_info.has_back_edge(node):
                 # For compatibility with older code, don't add back edges.
                 # (It would cause infinite loops before this was rewritten
                 # iteratively, with a 'node in reachable' check avoiding
@@ -274,11 +289,13 @@ def end_reachable_without(
         else:
             _: ReturnNode = node
 
+    spend_work(context, len(reachable))
     context.reachable_without[key] = reachable
     return end in reachable
 
 
-def get_reachable_nodes(start: Node) -> Set[Node]:
+def get_reachable_nodes(context: Context, start: Node) -> Set[Node]:
+    loop_info = context.flow_graph.loop_info
     reachable_nodes: Set[Node] = set()
     stack: List[Node] = [start]
     while stack:
@@ -289,13 +306,14 @@ def get_reachable_nodes(start: Node) -> Set[Node]:
         if isinstance(node, BasicNode):
             stack.append(node.successor)
         elif isinstance(node, ConditionalNode):
-            if not node.is_loop():
+            if not loop_info.has_back_edge(node):
                 stack.append(node.conditional_edge)
             stack.append(node.fallthrough_edge)
         elif isinstance(node, SwitchNode):
             stack.extend(node.cases)
         else:
             _: ReturnNode = node
+    spend_work(context, len(reachable_nodes))
     return reachable_nodes
 
 
@@ -311,7 +329,7 @@ def immediate_postdominator(context: Context, start: Node, end: Node) -> Node:
     # expression. That in turn can result in nodes emitted multiple times.
     # (TODO: this is rather ad hoc, we should probably come up with a more
     # principled approach to early returns...)
-    reachable_nodes = get_reachable_nodes(start)
+    reachable_nodes = get_reachable_nodes(context, start)
     if end not in reachable_nodes:
         end = max(reachable_nodes, key=lambda n: n.block.index)
 
@@ -335,7 +353,7 @@ def immediate_postdominator(context: Context, start: Node, end: Node) -> Node:
             if isinstance(node, BasicNode):
                 stack.append(node.successor)
             elif isinstance(node, ConditionalNode):
-                if not node.is_loop():
+                if not context.flow_graph.loop_info.has_back_edge(node):
                     # This check is wonky, see end_reachable_without.
                     # It should be kept the same as in get_reachable_nodes.
                     stack.append(node.conditional_edge)
@@ -344,6 +362,7 @@ def immediate_postdominator(context: Context, start: Node, end: Node) -> Node:
                 stack.extend(node.cases)
             else:
                 _: ReturnNode = node
+    spend_work(context, len(seen))
     assert len(postdominators) == 1, "we should always find exactly one postdominator"
     return postdominators[0]
 
@@ -487,6 +506,7 @@ def write_return(
         body.add_statement(SimpleStatement(indent, "return;"))
 
 
+@profiled("build_flowgraph_between")
 def build_flowgraph_between(
     context: Context, start: Node, end: Node, indent: int
 ) -> Body:
@@ -553,8 +573,8 @@ def build_flowgraph_between(
 
             # Advance to the next node in block order. This may skip over
             # unreachable blocks -- hopefully none too important.
-            index = context.flow_graph.nodes.index(curr_start)
-            fallthrough = context.flow_graph.nodes[index + 1]
+            fallthrough = context.flow_graph.next_node(curr_start)
+            assert fallthrough is not None
             if isinstance(curr_start, ConditionalNode):
                 assert fallthrough == curr_start.fallthrough_edge
             curr_start = fallthrough
@@ -596,17 +616,16 @@ def build_naive(context: Context, nodes: List[Node]) -> Body:
 
     body = Body(print_node_comment=context.options.debug)
 
-    def emit_successor(node: Node, cur_index: int) -> None:
+    def emit_successor(node: Node, cur_node: Node) -> None:
         if (
-            cur_index + 1 < len(nodes)
-            and nodes[cur_index + 1] == node
+            context.flow_graph.next_node(cur_node) == node
             and not (isinstance(node, ReturnNode) and not node.is_real())
         ):
             # Fallthrough is fine
             return
         emit_goto_or_early_return(context, node, body, 4)
 
-    for i, node in enumerate(nodes):
+    for node in nodes:
         block_info = node.block.block_info
         assert isinstance(block_info, BlockInfo)
         if isinstance(node, ReturnNode):
@@ -616,7 +635,7 @@ def build_naive(context: Context, nodes: List[Node]) -> Body:
             pass
         elif isinstance(node, BasicNode):
             emit_node(context, node, body, 4)
-            emit_successor(node.successor, i)
+            emit_successor(node.successor, node)
         elif isinstance(node, SwitchNode):
             emit_node(context, node, body, 4)
             assert block_info.switch_value is not None
@@ -631,11 +650,12 @@ def build_naive(context: Context, nodes: List[Node]) -> Body:
                     block_info.branch_condition, 4, if_body=if_body, else_body=None
                 )
             )
-            emit_successor(node.fallthrough_edge, i)
+            emit_successor(node.fallthrough_edge, node)
 
     return body
 
 
+@profiled("write_function")
 def write_function(function_info: FunctionInfo, options: Options) -> None:
     context = Context(flow_graph=function_info.flow_graph, options=options)
     start_node: Node = context.flow_graph.entry_node()
@@ -644,33 +664,41 @@ def write_function(function_info: FunctionInfo, options: Options) -> None:
         fictive_block = Block(-1, None, "", [])
         return_node = ReturnNode(fictive_block, False, index=-1)
 
-    num_switches = len(
-        [node for node in context.flow_graph.nodes if isinstance(node, SwitchNode)]
-    )
-    switch_index = 0
-    for node in context.flow_graph.nodes:
-        if isinstance(node, SwitchNode):
-            assert node.cases, "jtbl list must not be empty"
-            if num_switches > 1:
-                switch_index += 1
-            most_common = max(node.cases, key=node.cases.count)
-            context.case_nodes[most_common] = [(switch_index, -1)]
-            for index, target in enumerate(node.cases):
-                if target == most_common:
-                    continue
-                if target not in context.case_nodes:
-                    context.case_nodes[target] = []
-                context.case_nodes[target].append((switch_index, index))
-        elif isinstance(node, ConditionalNode) and node.is_loop():
-            context.loop_nodes.add(node.conditional_edge)
-        elif isinstance(node, BasicNode) and node.is_loop():
-            context.loop_nodes.add(node.successor)
+    for switch in context.flow_graph.switches.values():
+        assert switch.default is not None, "jtbl list must not be empty"
+        context.case_nodes[switch.default] = [(switch.index, -1)]
+        for (first, last, target) in switch.case_ranges:
+            if target == switch.default:
+                continue
+            if target not in context.case_nodes:
+                context.case_nodes[target] = []
+            context.case_nodes[target].extend(
+                (switch.index, index) for index in range(first, last + 1)
+            )
 
     if options.debug:
         print("Here's the whole function!\n")
     body: Body
     if options.ifs:
-        body = build_flowgraph_between(context, start_node, return_node, 4)
+        try:
+            body = build_flowgraph_between(context, start_node, return_node, 4)
+        except StructuringBudgetExceeded:
+            # Start over with gotos only, which takes linear time.
+            work = context.work
+            context = Context(
+                flow_graph=context.flow_graph,
+                options=options,
+                case_nodes=context.case_nodes,
+            )
+            body = build_naive(context, context.flow_graph.nodes)
+            body.statements.insert(
+                0,
+                SimpleStatement(
+                    4,
+                    f"// Gave up on structuring control flow after visiting "
+                    f"{work} nodes (--structure-budget)",
+                ),
+            )
     else:
         body = build_naive(context, context.flow_graph.nodes)
 
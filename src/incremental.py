@@ -0,0 +1,150 @@
+import functools
+import hashlib
+import json
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Set, Tuple
+
+import attr
+
+from .atomic_write import atomic_write
+from .options import Options
+from .parse_file import Function, Rodata
+from .parse_instruction import (
+    Argument,
+    AsmAddressMode,
+    AsmGlobalSymbol,
+    BinOp,
+    Instruction,
+    Macro,
+)
+
+INCREMENTAL_STATE_VERSION = 2
+
+
+@functools.lru_cache(maxsize=None)
+def source_hash() -> str:
+    """Hash the decompiler's source code. This is part of every key for reusing
+    output, so that results from other versions of the decompiler are thrown
+    away, without anyone having to remember to bump a version number."""
+    hasher = hashlib.sha1()
+    for path in sorted(Path(__file__).parent.glob("*.py")):
+        hasher.update(path.name.encode("utf-8"))
+        hasher.update(path.read_bytes())
+    return hasher.hexdigest()
+
+
+def argument_symbols(arg: Optional[Argument]) -> Iterator[str]:
+    if isinstance(arg, AsmGlobalSymbol):
+        yield arg.symbol_name
+    elif isinstance(arg, Macro):
+        yield from argument_symbols(arg.argument)
+    elif isinstance(arg, AsmAddressMode):
+        yield from argument_symbols(arg.lhs)
+    elif isinstance(arg, BinOp):
+        yield from argument_symbols(arg.lhs)
+        yield from argument_symbols(arg.rhs)
+
+
+def referenced_symbols(function: Function) -> Set[str]:
+    """Find the names of all global symbols used by a function."""
+    ret: Set[str] = set()
+    for item in function.body:
+        if isinstance(item, Instruction):
+            for arg in item.args:
+                ret.update(argument_symbols(arg))
+    return ret
+
+
+def function_hash(function: Function, rodata: Rodata) -> str:
+    """Hash the normalized instructions of a function, together with the
+    contents of the rodata symbols it refers to."""
+    hasher = hashlib.sha1()
+    hasher.update(function.name.encode("utf-8"))
+    for item in function.body:
+        line = str(item)
+        if isinstance(item, Instruction) and item.emit_goto:
+            line += " # GOTO"
+        hasher.update(line.encode("utf-8") + b"\n")
+    for sym in sorted(referenced_symbols(function)):
+        values = rodata.values.get(sym)
+        if values is not None:
+            hasher.update(json.dumps([sym, values]).encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def options_fingerprint(options: Options) -> str:
+    """Hash the options which affect the output for an already parsed
+    function. Options that only affect parsing are covered by function_hash."""
+    fields = [
+        source_hash(),
+        options.debug,
+        options.void,
+        options.ifs,
+        options.andor_detection,
+        options.stop_on_error,
+        options.print_assembly,
+        options.structure_budget,
+    ]
+    return hashlib.sha1(json.dumps(fields).encode("utf-8")).hexdigest()
+
+
+@attr.s
+class IncrementalState:
+    """Output from an earlier run, keyed by function name and hash. Functions
+    whose hash is unchanged since then do not need to be decompiled again.
+    The hash is part of the key since several functions may share a name."""
+
+    fingerprint: str = attr.ib()
+    entries: Dict[Tuple[str, str], str] = attr.ib(factory=dict)
+    seen: Set[Tuple[str, str]] = attr.ib(factory=set)
+    hits: int = attr.ib(default=0)
+    misses: int = attr.ib(default=0)
+
+    def lookup(self, name: str, hash: str) -> Optional[str]:
+        self.seen.add((name, hash))
+        output = self.entries.get((name, hash))
+        if output is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return output
+
+    def store(self, name: str, hash: str, output: str) -> None:
+        self.seen.add((name, hash))
+        self.entries[(name, hash)] = output
+
+
+def load_incremental_state(filename: str, options: Options) -> IncrementalState:
+    fingerprint = options_fingerprint(options)
+    state = IncrementalState(fingerprint)
+    try:
+        with open(filename, "r") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return state
+    if (
+        data.get("version") == INCREMENTAL_STATE_VERSION
+        and data.get("fingerprint") == fingerprint
+    ):
+        for entry in data["functions"]:
+            state.entries[(entry["name"], entry["hash"])] = entry["output"]
+    return state
+
+
+def save_incremental_state(filename: str, state: IncrementalState) -> None:
+    """Write out the state, keeping only functions that were seen during this
+    run so that the file does not grow as functions are changed or removed."""
+    functions = [
+        {"name": name, "hash": hash, "output": output}
+        for (name, hash), output in state.entries.items()
+        if (name, hash) in state.seen
+    ]
+    with atomic_write(filename) as f:
+        json.dump(
+            {
+                "version": INCREMENTAL_STATE_VERSION,
+                "fingerprint": state.fingerprint,
+                "functions": functions,
+            },
+            f,
+        )
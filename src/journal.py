@@ -0,0 +1,120 @@
+import json
+import os
+import time
+from typing import Any, Dict, List, Optional, TextIO, Tuple
+
+import attr
+
+from .atomic_write import atomic_write
+from .incremental import options_fingerprint
+from .options import Options
+
+JOURNAL_VERSION = 1
+
+# Statuses that depend on --timeout and --memory-limit rather than on the
+# function alone.
+LIMIT_STATUSES = ("TIMEOUT", "OOM")
+
+# How often to force the journal to disk, in seconds.
+SYNC_INTERVAL = 1.0
+
+
+@attr.s
+class JournalEntry:
+    hash: str = attr.ib()
+    status: str = attr.ib()
+    output: str = attr.ib()
+    error: Optional[str] = attr.ib(default=None)
+
+
+@attr.s
+class Journal:
+    """An append-only log of the functions decompiled so far in a batch run,
+    one JSON object per line. When a run is restarted, functions that are
+    already in the journal with the same hash are not decompiled again."""
+
+    file: TextIO = attr.ib()
+    # Entries by function name and hash.
+    entries: Dict[Tuple[str, str], JournalEntry] = attr.ib(factory=dict)
+    last_sync: float = attr.ib(factory=time.monotonic)
+    hits: int = attr.ib(default=0)
+
+    def lookup(self, name: str, hash: str) -> Optional[str]:
+        entry = self.entries.get((name, hash))
+        if entry is None:
+            return None
+        self.hits += 1
+        return entry.output
+
+    def record(
+        self, name: str, hash: str, status: str, output: str, error: Optional[str]
+    ) -> None:
+        entry = JournalEntry(hash, status, output, error)
+        self.entries[(name, hash)] = entry
+        self.file.write(json.dumps({"name": name, **attr.asdict(entry)}) + "\n")
+        self.file.flush()
+        now = time.monotonic()
+        if now - self.last_sync >= SYNC_INTERVAL:
+            os.fsync(self.file.fileno())
+            self.last_sync = now
+
+    def close(self) -> None:
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+
+def journal_header(options: Options) -> Dict[str, Any]:
+    return {
+        "version": JOURNAL_VERSION,
+        "fingerprint": options_fingerprint(options),
+        "timeout": options.timeout,
+        "memory_limit": options.memory_limit,
+    }
+
+
+def read_journal(filename: str) -> Tuple[List[Dict[str, Any]], bool]:
+    """Read the lines of a journal, stopping at the first one that is not
+    complete, e.g. because the previous run was killed while writing it.
+    Also return whether all of the file could be read."""
+    records: List[Dict[str, Any]] = []
+    try:
+        with open(filename) as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    return records, False
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    return records, False
+    except OSError:
+        return records, False
+    return records, True
+
+
+def open_journal(filename: str, options: Options) -> Journal:
+    """Open a journal to continue a run. Entries from a run with different
+    options are thrown away, and so are timeouts and out of memory errors if
+    the limits have changed."""
+    header = journal_header(options)
+    records, complete = read_journal(filename)
+    entries: Dict[Tuple[str, str], JournalEntry] = {}
+    same_limits = False
+    if records and records[0].get("fingerprint") == header["fingerprint"]:
+        same_limits = records[0] == header
+        for record in records[1:]:
+            if not same_limits and record["status"] in LIMIT_STATUSES:
+                continue
+            entries[(record["name"], record["hash"])] = JournalEntry(
+                record["hash"], record["status"], record["output"], record["error"]
+            )
+
+    if complete and same_limits:
+        return Journal(open(filename, "a"), entries)
+
+    # Start over with a compacted copy of the entries that are still valid.
+    with atomic_write(filename) as f:
+        f.write(json.dumps(header) + "\n")
+        for (name, _), entry in entries.items():
+            f.write(json.dumps({"name": name, **attr.asdict(entry)}) + "\n")
+    return Journal(open(filename, "a"), entries)
@@ -0,0 +1,397 @@
+import contextlib
+import copy
+import io
+import json
+import sys
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Set
+
+import attr
+
+from .incremental import referenced_symbols
+from .main import decompile_function_to_str
+from .options import Options
+from .parse_file import (
+    Function,
+    MIPSFile,
+    ParserState,
+    Rodata,
+    load_rodata_file,
+    parse_lines,
+)
+from .server import request_options
+
+
+@attr.s
+class Segment:
+    """A range of lines of a document, starting at a function label (except
+    possibly for the first segment), together with the results of parsing and
+    decompiling it."""
+
+    start: int = attr.ib()
+    state: ParserState = attr.ib()
+    function: Optional[Function] = attr.ib(default=None)
+    rodata: Dict[str, List[str]] = attr.ib(factory=dict)
+    # Rodata values before the first rodata symbol of the segment, which
+    # belong to the symbol open at its start, state.rodata_symbol.
+    rodata_tail: List[str] = attr.ib(factory=list)
+    symbols: Set[str] = attr.ib(factory=set)
+    output: Optional[str] = attr.ib(default=None)
+    dirty: bool = attr.ib(default=True)
+
+
+def parse_region(
+    lines: List[str], start: int, end: int, state: ParserState, options: Options
+) -> List[Segment]:
+    """Parse lines[start:end], starting from the given parser state, which is
+    updated to the state at the end. The lines are split into segments at
+    function labels."""
+    mips_file = MIPSFile(options.filename)
+    segments = [Segment(start, copy.deepcopy(state))]
+    mips_file.current_rodata = segments[0].rodata_tail
+
+    # Segments that rodata symbols were started in, keyed by the id of the list
+    # holding their values.
+    rodata_segments: Dict[int, Segment] = {}
+
+    def tracked_lines() -> Iterator[str]:
+        num_functions = 0
+        current_rodata = mips_file.current_rodata
+        for i in range(start, end):
+            yield lines[i]
+            # The parser has now handled line i.
+            if len(mips_file.functions) != num_functions:
+                num_functions = len(mips_file.functions)
+                function = mips_file.functions[-1]
+                if i == start:
+                    segments[-1].function = function
+                else:
+                    # Functions only start at the top level of .text sections.
+                    # The list of .ifdef levels is shared with the parser.
+                    ifdef_levels = list(state.ifdef_levels)
+                    segment_state = ParserState(
+                        ".text", 0, ifdef_levels, mips_file.current_rodata_symbol
+                    )
+                    segments.append(Segment(i, segment_state, function))
+                    # Values from here on belong to the new segment, so that
+                    # it can be parsed again on its own.
+                    mips_file.current_rodata = segments[-1].rodata_tail
+                    current_rodata = mips_file.current_rodata
+            if mips_file.current_rodata is not current_rodata:
+                current_rodata = mips_file.current_rodata
+                rodata_segments[id(current_rodata)] = segments[-1]
+
+    parse_lines(tracked_lines(), options, mips_file, False, state)
+    for sym, values in mips_file.rodata.values.items():
+        rodata_segments[id(values)].rodata[sym] = values
+    for segment in segments:
+        if segment.function is not None:
+            segment.symbols = referenced_symbols(segment.function)
+    return segments
+
+
+def starts_function(line: str, state: ParserState, options: Options) -> bool:
+    mips_file = MIPSFile(options.filename)
+    try:
+        parse_lines([line], options, mips_file, False, copy.deepcopy(state))
+    except Exception:
+        return False
+    return bool(mips_file.functions)
+
+
+@attr.s
+class Document:
+    """An open assembly file. Each edit only causes the segments it touches to
+    be parsed again, and only functions whose instructions or rodata changed
+    to be decompiled again."""
+
+    options: Options = attr.ib()
+    lines: List[str] = attr.ib()
+    extra_rodata: Rodata = attr.ib()
+    segments: List[Segment] = attr.ib()
+    rodata: Rodata = attr.ib(factory=Rodata)
+
+    def replace_lines(self, start: int, end: int, new_lines: List[str]) -> None:
+        delta = len(new_lines) - (end - start)
+        self.lines[start:end] = new_lines
+        kept: List[Segment] = []
+        for i, segment in enumerate(self.segments):
+            seg_end = (
+                self.segments[i + 1].start
+                if i + 1 < len(self.segments)
+                else len(self.lines) - delta
+            )
+            if start < segment.start < end:
+                # The label starting this segment was replaced, so its lines
+                # are now part of the previous segment.
+                kept[-1].dirty = True
+                continue
+            if segment.start < max(end, start + 1) and seg_end > start:
+                segment.dirty = True
+            elif segment.start >= end and segment.start > start:
+                segment.start += delta
+            kept.append(segment)
+        if not kept or kept[0].start != 0:
+            kept.insert(0, Segment(0, ParserState()))
+        self.segments = kept
+
+    def apply_change(self, change: Dict[str, Any]) -> None:
+        text: str = change["text"]
+        if "range" not in change:
+            # The whole document was sent; find the lines that differ.
+            new_lines = text.split("\n")
+            old_lines = self.lines
+            limit = min(len(old_lines), len(new_lines))
+            prefix = 0
+            while prefix < limit and old_lines[prefix] == new_lines[prefix]:
+                prefix += 1
+            suffix = 0
+            while (
+                suffix < limit - prefix
+                and old_lines[-1 - suffix] == new_lines[-1 - suffix]
+            ):
+                suffix += 1
+            self.replace_lines(
+                prefix,
+                len(old_lines) - suffix,
+                new_lines[prefix : len(new_lines) - suffix],
+            )
+            return
+
+        start, end = change["range"]["start"], change["range"]["end"]
+        start_line = min(start["line"], len(self.lines) - 1)
+        end_line = min(end["line"], len(self.lines) - 1)
+        before = self.lines[start_line][: start["character"]]
+        after = self.lines[end_line][end["character"] :]
+        new_lines = (before + text + after).split("\n")
+        self.replace_lines(start_line, end_line + 1, new_lines)
+
+    def parse_dirty(self) -> Set[str]:
+        """Parse all dirty segments again, and return the names of the rodata
+        symbols that were added, removed or changed."""
+        segments = self.segments
+        touched: Set[str] = set()
+        i = 0
+        while i < len(segments):
+            if not segments[i].dirty:
+                i += 1
+                continue
+            j = i
+            while j + 1 < len(segments) and segments[j + 1].dirty:
+                j += 1
+            while True:
+                start = segments[i].start
+                end = (
+                    segments[j + 1].start if j + 1 < len(segments) else len(self.lines)
+                )
+                if i > 0 and not starts_function(
+                    self.lines[start], segments[i].state, self.options
+                ):
+                    # The region no longer starts with a function label.
+                    i -= 1
+                    continue
+                state = copy.deepcopy(segments[i].state)
+                try:
+                    new_segments = parse_region(
+                        self.lines, start, end, state, self.options
+                    )
+                except Exception as e:
+                    # Most likely the function is in the middle of being
+                    # edited. Try again after the next edit.
+                    failed = Segment(start, segments[i].state)
+                    failed.output = (
+                        f"// Failed to parse lines {start + 1}-{end}: {e}\n\n"
+                    )
+                    new_segments = [failed]
+                    break
+                if j + 1 < len(segments) and state != segments[j + 1].state:
+                    # The parser state after the region changed, e.g. because
+                    # of an .ifdef, so the next segment must be parsed again.
+                    j += 1
+                    continue
+                for segment in new_segments:
+                    segment.dirty = False
+                break
+            for segment in segments[i : j + 1] + new_segments:
+                touched.update(segment.rodata)
+                if segment.rodata_tail and segment.state.rodata_symbol is not None:
+                    touched.add(segment.state.rodata_symbol)
+            segments[i : j + 1] = new_segments
+            i += len(new_segments)
+
+        old_values = self.rodata.values
+        values: Dict[str, List[str]] = {}
+        for segment in segments:
+            sym = segment.state.rodata_symbol
+            if segment.rodata_tail and sym is not None and sym in values:
+                values[sym] = values[sym] + segment.rodata_tail
+            values.update(segment.rodata)
+        values.update(self.extra_rodata.values)
+        self.rodata = Rodata(values)
+        return {sym for sym in touched if old_values.get(sym) != values.get(sym)}
+
+    def update(self) -> List[str]:
+        """Bring the output up to date, and return the names of the functions
+        that were decompiled again."""
+        changed_symbols = self.parse_dirty()
+        decompiled: List[str] = []
+        index = 0
+        for segment in self.segments:
+            function = segment.function
+            if function is None:
+                continue
+            if segment.output is None or segment.symbols & changed_symbols:
+                segment.output = decompile_function_to_str(
+                    self.options, function, self.rodata, index
+                )
+                decompiled.append(function.name)
+            index += 1
+        return decompiled
+
+    def output(self) -> str:
+        return "".join(s.output for s in self.segments if s.output is not None)
+
+
+def open_document(text: str, options: Options) -> Document:
+    options.stop_on_error = True
+    extra_rodata = Rodata()
+    for rodata_file in options.rodata_files:
+        extra_rodata.merge(load_rodata_file(rodata_file, options))
+    return Document(
+        options=options,
+        lines=text.split("\n"),
+        extra_rodata=extra_rodata,
+        segments=[Segment(0, ParserState())],
+    )
+
+
+def uri_to_filename(uri: str) -> str:
+    return uri[len("file://") :] if uri.startswith("file://") else uri
+
+
+@attr.s
+class LanguageServer:
+    """A language server speaking JSON-RPC with Content-Length framing. Open
+    .s documents are decompiled as they change, and the C output is pushed to
+    the client as a "mips_to_c/output" notification holding the full text of
+    a virtual document."""
+
+    infile: BinaryIO = attr.ib()
+    outfile: BinaryIO = attr.ib()
+    init_options: Dict[str, Any] = attr.ib(factory=dict)
+    documents: Dict[str, Document] = attr.ib(factory=dict)
+    shutting_down: bool = attr.ib(default=False)
+
+    def read_message(self) -> Optional[Dict[str, Any]]:
+        length: Optional[int] = None
+        while True:
+            header = self.infile.readline()
+            if not header:
+                return None
+            header = header.strip()
+            if not header:
+                break
+            name, _, value = header.decode("ascii").partition(":")
+            if name.strip().lower() == "content-length":
+                length = int(value)
+        if length is None:
+            return {}
+        msg: Dict[str, Any] = json.loads(self.infile.read(length))
+        return msg
+
+    def send(self, msg: Dict[str, Any]) -> None:
+        body = json.dumps({"jsonrpc": "2.0", **msg}).encode("utf-8")
+        self.outfile.write(f"Content-Length: {len(body)}\r\n\r\n".encode("ascii"))
+        self.outfile.write(body)
+        self.outfile.flush()
+
+    def log(self, message: str) -> None:
+        if message:
+            self.send(
+                {
+                    "method": "window/logMessage",
+                    "params": {"type": 4, "message": message},
+                }
+            )
+
+    def refresh(self, uri: str, version: Optional[int]) -> None:
+        doc = self.documents[uri]
+        # Anything printed while parsing, e.g. notes about preprocessor
+        # constants, must not end up in the protocol stream.
+        with contextlib.redirect_stdout(io.StringIO()) as f:
+            decompiled = doc.update()
+        self.log(f.getvalue())
+        self.send(
+            {
+                "method": "mips_to_c/output",
+                "params": {
+                    "uri": uri,
+                    "version": version,
+                    "text": doc.output(),
+                    "changed": decompiled,
+                },
+            }
+        )
+
+    def handle(self, msg: Dict[str, Any]) -> None:
+        method = msg.get("method")
+        params = msg.get("params", {})
+        result: Any = None
+        if method == "initialize":
+            self.init_options = params.get("initializationOptions") or {}
+            result = {
+                "capabilities": {"textDocumentSync": {"openClose": True, "change": 2}},
+                "serverInfo": {"name": "mips_to_c"},
+            }
+        elif method == "shutdown":
+            self.shutting_down = True
+        elif method == "textDocument/didOpen":
+            item = params["textDocument"]
+            uri = item["uri"]
+            options = request_options(
+                {"filename": uri_to_filename(uri), "options": self.init_options}
+            )
+            with contextlib.redirect_stdout(io.StringIO()) as f:
+                self.documents[uri] = open_document(item["text"], options)
+            self.log(f.getvalue())
+            self.refresh(uri, item.get("version"))
+        elif method == "textDocument/didChange":
+            uri = params["textDocument"]["uri"]
+            for change in params["contentChanges"]:
+                self.documents[uri].apply_change(change)
+            self.refresh(uri, params["textDocument"].get("version"))
+        elif method == "textDocument/didClose":
+            self.documents.pop(params["textDocument"]["uri"], None)
+        elif "id" in msg:
+            self.send(
+                {
+                    "id": msg["id"],
+                    "error": {"code": -32601, "message": f"Unknown method {method}"},
+                }
+            )
+            return
+        if "id" in msg:
+            self.send({"id": msg["id"], "result": result})
+
+    def run(self) -> int:
+        while True:
+            msg = self.read_message()
+            if msg is None:
+                return 1
+            if msg.get("method") == "exit":
+                return 0 if self.shutting_down else 1
+            try:
+                self.handle(msg)
+            except Exception as e:
+                if "id" in msg:
+                    self.send(
+                        {
+                            "id": msg["id"],
+                            "error": {"code": -32603, "message": str(e)},
+                        }
+                    )
+                else:
+                    self.log(f"Error handling {msg.get('method')}: {e}")
+
+
+def serve_lsp() -> int:
+    return LanguageServer(sys.stdin.buffer, sys.stdout.buffer).run()
@@ -1,78 +1,331 @@
 import argparse
+import contextlib
+import io
 import sys
+from typing import Iterable, Iterator, Optional, Tuple
 
+from .asm_file import open_asm_file
 from .error import DecompFailure
 from .flow_graph import build_flowgraph, visualize_flowgraph
 from .if_statements import write_function
-from .options import Options
-from .parse_file import Function, Rodata, parse_file
-from .translate import translate_to_ast
+from .incremental import (
+    function_hash,
+    load_incremental_state,
+    save_incremental_state,
+)
+from . import profiling
+from .journal import open_journal
+from .options import DEFAULT_STRUCTURE_BUDGET, Options
+from .output_dir import open_output_dir
+from .parse_file import (
+    Function,
+    MIPSFile,
+    Rodata,
+    iter_functions,
+    load_rodata_file,
+    parse_file,
+    parse_file_parallel,
+    parse_rodata,
+)
+from .profiling import Profiler, profile_function, profile_parse, report
+from .result_cache import open_result_cache, result_cache_key
+from .results_db import open_results_db
+from .shard import Sharder, merge_shards, parse_shard
+from .translate import FunctionInfo, translate_to_ast
 
 
-def decompile_function(options: Options, function: Function, rodata: Rodata) -> None:
+def decompile_function(
+    options: Options, function: Function, rodata: Rodata, index: int
+) -> Optional[FunctionInfo]:
+    """Decompile a function, given its index in the input."""
     if options.print_assembly:
         print(function)
         print()
 
     if options.visualize_flowgraph:
         visualize_flowgraph(build_flowgraph(function, rodata))
-        return
+        return None
 
-    function_info = translate_to_ast(function, options, rodata)
-    write_function(function_info, options)
+    with profile_function(function.name, index):
+        function_info = translate_to_ast(function, options, rodata)
+        write_function(function_info, options)
+    return function_info
 
 
-def run(options: Options, function_index_or_name: str) -> int:
-    with open(options.filename, "r") as f:
-        mips_file = parse_file(f, options)
+def decompile_all(
+    options: Options, functions: Iterable[Function], rodata: Rodata
+) -> None:
+    options.stop_on_error = True
+    sharder: Optional[Sharder] = None
+    if options.shard is not None:
+        sharder = Sharder(*options.shard, by=options.shard_by)
+
+    isolate = options.timeout is not None or options.memory_limit is not None
+    if options.visualize_flowgraph or (
+        options.incremental_state is None
+        and options.result_cache is None
+        and not isolate
+        and options.jobs <= 1
+        and options.cost_report is None
+        and options.journal is None
+        and options.results_db is None
+        and options.output_dir is None
+    ):
+        selected = sharder.select(functions) if sharder else enumerate(functions)
+        for index, fn in selected:
+            if sharder is not None:
+                sys.stdout.write(sharder.marker(index, fn))
+            decompile_function_or_error(options, fn, rodata, index)
+    else:
+        decompile_batch(options, functions, rodata, sharder)
+    if (
+        sharder is not None
+        and options.results_db is None
+        and options.output_dir is None
+    ):
+        sys.stdout.write(sharder.trailer())
+
+
+def decompile_batch(
+    options: Options,
+    functions: Iterable[Function],
+    rodata: Rodata,
+    sharder: Optional[Sharder],
+) -> None:
+    """Decompile functions, reusing earlier output from --incremental or
+    --result-cache, and isolating them or spreading them over several
+    processes if asked to."""
+    # Imported here, since the batch module itself uses decompile_function.
+    from .batch import OOM, TIMEOUT, BatchTask, cost_features, run_tasks
+
+    state = (
+        load_incremental_state(options.incremental_state, options)
+        if options.incremental_state is not None
+        else None
+    )
+    cache = (
+        open_result_cache(options.result_cache, options.result_cache_size)
+        if options.result_cache is not None
+        else None
+    )
+    journal = (
+        open_journal(options.journal, options) if options.journal is not None else None
+    )
+    db = (
+        open_results_db(options.results_db, options)
+        if options.results_db is not None
+        else None
+    )
+    output_dir = (
+        open_output_dir(options.output_dir, options.shard)
+        if options.output_dir is not None
+        else None
+    )
+
+    selected: Iterable[Tuple[int, Function]] = enumerate(functions)
+    if sharder is not None:
+        # Shards may share an output directory, so file names are picked
+        # among the functions of all shards.
+        def skipped(index: int, fn: Function) -> None:
+            if output_dir is not None:
+                output_dir.reserve(index, fn.name)
+
+        selected = sharder.select(functions, skipped)
 
-        # Move over jtbl rodata from files given by --rodata
+    def tasks() -> Iterator[BatchTask]:
+        for index, fn in selected:
+            output: Optional[str] = None
+            fn_hash = function_hash(fn, rodata)
+            if output_dir is not None:
+                output_dir.assign(index, fn.name)
+            if db is not None:
+                output = db.lookup(index, fn.name, fn_hash)
+            if output is None and journal is not None:
+                output = journal.lookup(fn.name, fn_hash)
+            if output is None and state is not None:
+                output = state.lookup(fn.name, fn_hash)
+            if output is None and cache is not None:
+                output = cache.get(result_cache_key(fn_hash, options))
+            yield BatchTask(index, fn, fn_hash, output)
+
+    def record(task: BatchTask) -> None:
+        assert task.result is not None
+        result = task.result
+        if journal is not None:
+            journal.record(
+                result.name, task.fn_hash, result.status, result.output, result.error
+            )
+        if db is not None:
+            db.store(
+                task.index,
+                result.name,
+                task.fn_hash,
+                result.status,
+                result.output,
+                result.error,
+                result.elapsed,
+                result.phase_times,
+                cost_features(task.function).instructions,
+                result.nodes,
+            )
+        if output_dir is not None:
+            output_dir.write_function(
+                task.index, result.name, result.output, result.status
+            )
+
+    on_done = (
+        record
+        if journal is not None or db is not None or output_dir is not None
+        else None
+    )
+    for task in run_tasks(options, rodata, tasks(), on_done):
+        fn = task.function
+        output = task.output
+        remember = True
+        if task.result is not None:
+            result = task.result
+            output = result.output
+            # Running out of time or memory is not a property of the
+            # function alone, so don't remember it.
+            remember = result.status not in (TIMEOUT, OOM)
+            if cache is not None and remember:
+                cache.put(result_cache_key(task.fn_hash, options), output)
+        assert output is not None
+        if state is not None and remember:
+            state.store(fn.name, task.fn_hash, output)
+        if output_dir is not None and task.result is None:
+            output_dir.write_function(task.index, fn.name, output, None)
+        if db is not None or output_dir is not None:
+            continue
+        if sharder is not None:
+            sys.stdout.write(sharder.marker(task.index, fn))
+        sys.stdout.write(output)
+
+    if state is not None:
+        assert options.incremental_state is not None
+        save_incremental_state(options.incremental_state, state)
+        print(
+            f"Incremental: reused {state.hits} functions, "
+            f"decompiled {state.misses}.",
+            file=sys.stderr,
+        )
+    if cache is not None:
+        cache.close()
+        print(f"Result cache: {cache.stats}.", file=sys.stderr)
+    if journal is not None:
+        journal.close()
+        print(f"Journal: resumed {journal.hits} functions.", file=sys.stderr)
+    if db is not None:
+        # Other shards have rows of their own, so only clean up after full runs.
+        db.close(saw_all_functions=sharder is None)
+        print(
+            f"Stored {db.stored} functions in {options.results_db}, "
+            f"{db.hits} were already there.",
+            file=sys.stderr,
+        )
+    if output_dir is not None:
+        output_dir.close()
+        print(
+            f"Wrote {output_dir.written} functions to {options.output_dir}, "
+            f"{output_dir.unchanged} were unchanged.",
+            file=sys.stderr,
+        )
+
+
+def decompile_function_to_str(
+    options: Options, function: Function, rodata: Rodata, index: int
+) -> str:
+    with contextlib.redirect_stdout(io.StringIO()) as f:
+        decompile_function_or_error(options, function, rodata, index)
+    return f.getvalue()
+
+
+def decompile_function_or_error(
+    options: Options, function: Function, rodata: Rodata, index: int
+) -> None:
+    try:
+        decompile_function(options, function, rodata, index)
+    except Exception:
+        print(f"{function.name}: ERROR")
+    print()
+
+
+def run_all_streaming(options: Options) -> int:
+    """Decompile every function in the input, parsing each one only right
+    before it is decompiled. Nothing refers to a function once it has been
+    output, so memory use stays flat regardless of the size of the input."""
+    with open_asm_file(options.filename) as asm_file:
+        # Rodata may come after the functions that use it, so collect it in a
+        # separate pass first.
+        rodata = parse_rodata(asm_file.lines(), options)
         for rodata_file in options.rodata_files:
-            with open(rodata_file, "r") as f2:
-                sub_file = parse_file(f2, options)
-                for (sym, value) in sub_file.rodata.values.items():
-                    mips_file.rodata.values[sym] = value
-
-        if function_index_or_name == "all":
-            options.stop_on_error = True
-            for fn in mips_file.functions:
-                try:
-                    decompile_function(options, fn, mips_file.rodata)
-                except Exception:
-                    print(f"{fn.name}: ERROR")
-                print()
+            rodata.merge(load_rodata_file(rodata_file, options))
+        functions: Iterable[Function] = iter_functions(asm_file.lines(), options)
+        if profiling.profiler is not None:
+            functions = profile_parse(functions)
+        decompile_all(options, functions, rodata)
+    return 0
+
+
+def run(options: Options, function_index_or_name: str) -> int:
+    if function_index_or_name == "all" and options.parse_jobs <= 1:
+        return run_all_streaming(options)
+
+    with open_asm_file(options.filename) as asm_file:
+        if options.parse_jobs > 1:
+            mips_file = parse_file_parallel(asm_file, options, options.parse_jobs)
         else:
+            mips_file = parse_file(asm_file.lines(), options)
+
+    # Move over jtbl rodata from files given by --rodata
+    for rodata_file in options.rodata_files:
+        mips_file.rodata.merge(load_rodata_file(rodata_file, options))
+
+    return decompile_selected(options, mips_file, function_index_or_name)
+
+
+def decompile_selected(
+    options: Options, mips_file: MIPSFile, function_index_or_name: str
+) -> int:
+    if function_index_or_name == "all":
+        decompile_all(options, mips_file.functions, mips_file.rodata)
+    else:
+        try:
+            index = int(function_index_or_name)
+            function = mips_file.functions[index]
+            index %= len(mips_file.functions)
+        except ValueError:
+            name = function_index_or_name
             try:
-                index = int(function_index_or_name)
-                function = mips_file.functions[index]
-            except ValueError:
-                name = function_index_or_name
-                try:
-                    function = next(f for f in mips_file.functions if f.name == name)
-                except StopIteration:
-                    print(f"Function {name} not found.", file=sys.stderr)
-                    return 1
-            except IndexError:
-                count = len(mips_file.functions)
-                print(
-                    f"Function index {index} is out of bounds (must be between "
-                    f"0 and {count - 1}).",
-                    file=sys.stderr,
+                index, function = next(
+                    (i, f) for i, f in enumerate(mips_file.functions) if f.name == name
                 )
+            except StopIteration:
+                print(f"Function {name} not found.", file=sys.stderr)
                 return 1
+        except IndexError:
+            count = len(mips_file.functions)
+            print(
+                f"Function index {index} is out of bounds (must be between "
+                f"0 and {count - 1}).",
+                file=sys.stderr,
+            )
+            return 1
 
-            try:
-                decompile_function(options, function, mips_file.rodata)
-            except DecompFailure as e:
-                print(f"Failed to decompile function {function.name}:\n\n{e}")
-                return 1
-        return 0
+        try:
+            decompile_function(options, function, mips_file.rodata, index)
+        except DecompFailure as e:
+            print(f"Failed to decompile function {function.name}:\n\n{e}")
+            return 1
+    return 0
 
 
 def main() -> int:
     parser = argparse.ArgumentParser(description="Decompile MIPS assembly to C.")
-    parser.add_argument("filename", help="input filename")
-    parser.add_argument("function", help="function index or name (or 'all')", type=str)
+    parser.add_argument("filename", help="input filename", nargs="?")
+    parser.add_argument(
+        "function", help="function index or name (or 'all')", type=str, nargs="?"
+    )
     parser.add_argument(
         "--debug", dest="debug", help="print debug info", action="store_true"
     )
@@ -112,6 +365,138 @@ def main() -> int:
         default=[],
         help="read jump table data from this file",
     )
+    parser.add_argument(
+        "--rodata-cache",
+        metavar="DIR",
+        dest="rodata_cache_dir",
+        help="cache the contents of --rodata files in this directory between runs",
+    )
+    parser.add_argument(
+        "--incremental",
+        metavar="STATE_FILE",
+        dest="incremental_state",
+        help="with 'all', keep the output for each function in this file, and "
+        "only decompile functions which have changed since the last run",
+    )
+    parser.add_argument(
+        "--result-cache",
+        metavar="DB_FILE",
+        dest="result_cache",
+        help="with 'all', store the output for each function in this SQLite "
+        "database, keyed by its contents, and reuse it when seen again",
+    )
+    parser.add_argument(
+        "--result-cache-size",
+        metavar="MB",
+        dest="result_cache_size",
+        type=int,
+        default=100,
+        help="evict the least recently used output from the --result-cache "
+        "database when it grows above this size. Default: 100",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        metavar="N",
+        dest="jobs",
+        type=int,
+        default=1,
+        help="with 'all', decompile functions using N processes. The functions "
+        "expected to take longest are started first",
+    )
+    parser.add_argument(
+        "--cost-report",
+        metavar="JSON_FILE",
+        dest="cost_report",
+        help="with 'all', write the predicted and actual time taken by each "
+        "function to this file, for tuning the cost model used by --jobs",
+    )
+    parser.add_argument(
+        "--journal",
+        metavar="FILE",
+        dest="journal",
+        help="with 'all', append the result of each function to this file as "
+        "soon as it is done. If the run is interrupted, running it again "
+        "with the same options picks up where it left off",
+    )
+    parser.add_argument(
+        "--db",
+        metavar="DB_FILE",
+        dest="results_db",
+        help="with 'all', store the output, status, error message and timings "
+        "of each function in this SQLite database instead of printing them. "
+        "Functions already stored with the same input and options are "
+        "skipped",
+    )
+    parser.add_argument(
+        "--output-dir",
+        metavar="DIR",
+        dest="output_dir",
+        help="with 'all', write the output for each function to its own file "
+        "in this directory instead of printing it, along with a "
+        "manifest.json listing them in order. Files whose contents have "
+        "not changed are not touched",
+    )
+    parser.add_argument(
+        "--timeout",
+        metavar="SECONDS",
+        dest="timeout",
+        type=float,
+        help="with 'all', decompile each function in a separate process, and "
+        "give up on functions that take longer than this, printing TIMEOUT",
+    )
+    parser.add_argument(
+        "--memory-limit",
+        metavar="MB",
+        dest="memory_limit",
+        type=int,
+        help="with 'all', decompile each function in a separate process, and "
+        "give up on functions that need more memory than this, printing OOM",
+    )
+    parser.add_argument(
+        "--parse-jobs",
+        metavar="N",
+        dest="parse_jobs",
+        type=int,
+        default=1,
+        help="parse the input file using N processes (useful for large files)",
+    )
+    parser.add_argument(
+        "--structure-budget",
+        metavar="NODES",
+        dest="structure_budget",
+        type=int,
+        default=DEFAULT_STRUCTURE_BUDGET,
+        help="give up on if/else structuring of a function once this many "
+        "nodes have been visited looking for postdominators, and emit gotos "
+        f"for it instead. 0 means no limit. Default: {DEFAULT_STRUCTURE_BUDGET}",
+    )
+    parser.add_argument(
+        "--shard",
+        metavar="K/N",
+        dest="shard",
+        help="with 'all', only decompile the K-th of N roughly equal parts of "
+        "the functions, for splitting a run across machines. The output "
+        "marks each function, so that the parts can be put back together "
+        "with --merge-shards",
+    )
+    parser.add_argument(
+        "--shard-by",
+        dest="shard_by",
+        choices=["hash", "size"],
+        default="hash",
+        help="how to split functions for --shard: by a hash of their name, or "
+        "so that each part gets about the same number of instructions. "
+        "Default: hash",
+    )
+    parser.add_argument(
+        "--merge-shards",
+        metavar="FILE",
+        dest="merge_shards",
+        nargs="+",
+        help="instead of decompiling a file, combine the outputs of all parts "
+        "of a --shard run, with functions in their original order",
+    )
     parser.add_argument(
         "--stop-on-error",
         dest="stop_on_error",
@@ -130,6 +515,59 @@ def main() -> int:
         action="store_true",
         help="display a visualization of the control flow graph using graphviz",
     )
+    parser.add_argument(
+        "--profile",
+        dest="profile",
+        action="store_true",
+        help="print the time spent in each phase of decompilation, per "
+        "function and in total, to stderr",
+    )
+    parser.add_argument(
+        "--profile-format",
+        dest="profile_format",
+        choices=["table", "json"],
+        default="table",
+        help="output format for --profile. Default: table",
+    )
+    parser.add_argument(
+        "--profile-function",
+        metavar="NAME",
+        dest="profile_function",
+        help="with --profile, also run a profiler while decompiling this function",
+    )
+    parser.add_argument(
+        "--profile-hook",
+        dest="profile_hook",
+        choices=["cprofile", "tracemalloc"],
+        default="cprofile",
+        help="profiler to use for --profile-function: cProfile for time spent "
+        "per Python function, or tracemalloc for memory allocations. "
+        "Default: cprofile",
+    )
+    parser.add_argument(
+        "--serve",
+        metavar="SOCKET",
+        dest="serve",
+        nargs="?",
+        const="-",
+        help="instead of decompiling a file, run as a server answering "
+        "JSON-lines requests on stdin/stdout, or on a Unix socket at SOCKET "
+        "if given. Parsed files are kept in memory between requests",
+    )
+    parser.add_argument(
+        "--serve-workers",
+        metavar="N",
+        dest="serve_workers",
+        type=int,
+        help="number of worker processes for --serve. Default: number of CPUs",
+    )
+    parser.add_argument(
+        "--lsp",
+        dest="lsp",
+        action="store_true",
+        help="instead of decompiling a file, run as a language server on "
+        "stdin/stdout, which decompiles open documents as they are edited",
+    )
     parser.add_argument(
         "-D",
         dest="defined",
@@ -145,6 +583,40 @@ def main() -> int:
         help="mark preprocessor constant as undefined",
     )
     args = parser.parse_args()
+    if args.serve is not None:
+        from .server import serve
+
+        return serve(args.serve, args.serve_workers)
+    if args.lsp:
+        from .lsp import serve_lsp
+
+        return serve_lsp()
+    if args.merge_shards:
+        with contextlib.ExitStack() as stack:
+            inputs = [stack.enter_context(open(f)) for f in args.merge_shards]
+            return merge_shards(inputs, sys.stdout)
+    if args.filename is None or args.function is None:
+        parser.error("the following arguments are required: filename, function")
+
+    shard: Optional[Tuple[int, int]] = None
+    if args.shard is not None:
+        try:
+            shard = parse_shard(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+
+    if args.results_db is not None:
+        for flag, value in [
+            ("--incremental", args.incremental_state),
+            ("--result-cache", args.result_cache),
+            ("--journal", args.journal),
+        ]:
+            if value is not None:
+                parser.error(
+                    f"--db cannot be combined with {flag}; it already skips "
+                    "functions it has results for"
+                )
+
     preproc_defines = {
         **{d: 0 for d in args.undefined},
         **{d.split("=")[0]: 1 for d in args.defined},
@@ -161,8 +633,37 @@ def main() -> int:
         print_assembly=args.print_assembly,
         visualize_flowgraph=args.visualize,
         preproc_defines=preproc_defines,
+        rodata_cache_dir=args.rodata_cache_dir,
+        parse_jobs=args.parse_jobs,
+        incremental_state=args.incremental_state,
+        result_cache=args.result_cache,
+        result_cache_size=args.result_cache_size * 1024 * 1024,
+        structure_budget=args.structure_budget or None,
+        shard=shard,
+        shard_by=args.shard_by,
+        jobs=args.jobs,
+        cost_report=args.cost_report,
+        journal=args.journal,
+        results_db=args.results_db,
+        output_dir=args.output_dir,
+        timeout=args.timeout,
+        memory_limit=(
+            args.memory_limit * 1024 * 1024 if args.memory_limit is not None else None
+        ),
     )
-    return run(options, args.function)
+    if not args.profile:
+        return run(options, args.function)
+
+    profiler = Profiler(hook_function=args.profile_function, hook=args.profile_hook)
+    profiling.profiler = profiler
+    try:
+        return run(options, args.function)
+    finally:
+        profiling.profiler = None
+        if args.profile_format == "json":
+            report(profiler.format_json())
+        else:
+            report(profiler.format_table())
 
 
 if __name__ == "__main__":
@@ -1,7 +1,10 @@
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
 
 import attr
 
+# Number of nodes structuring may visit before falling back to gotos.
+DEFAULT_STRUCTURE_BUDGET = 10_000_000
+
 
 @attr.s
 class Options:
@@ -16,3 +19,29 @@ class Options:
     print_assembly: bool = attr.ib()
     visualize_flowgraph: bool = attr.ib()
     preproc_defines: Dict[str, int] = attr.ib()
+    rodata_cache_dir: Optional[str] = attr.ib(default=None)
+    parse_jobs: int = attr.ib(default=1)
+    incremental_state: Optional[str] = attr.ib(default=None)
+    result_cache: Optional[str] = attr.ib(default=None)
+    result_cache_size: int = attr.ib(default=100 * 1024 * 1024)
+    # Number of processes to decompile functions with 'all' in, and where to
+    # write predicted and actual times for each of them.
+    jobs: int = attr.ib(default=1)
+    cost_report: Optional[str] = attr.ib(default=None)
+    # File to log the result of each function to with 'all', so that an
+    # interrupted run can be resumed.
+    journal: Optional[str] = attr.ib(default=None)
+    # SQLite database to store results in with 'all', instead of printing them.
+    results_db: Optional[str] = attr.ib(default=None)
+    # Directory to write the output for each function to with 'all', one file
+    # per function, instead of printing it.
+    output_dir: Optional[str] = attr.ib(default=None)
+    # Limits for decompiling each function with 'all', in seconds and bytes.
+    timeout: Optional[float] = attr.ib(default=None)
+    memory_limit: Optional[int] = attr.ib(default=None)
+    # None means no limit.
+    structure_budget: Optional[int] = attr.ib(default=DEFAULT_STRUCTURE_BUDGET)
+    # Which of how many parts of the functions to decompile with 'all', and
+    # whether to split them by "hash" or "size".
+    shard: Optional[Tuple[int, int]] = attr.ib(default=None)
+    shard_by: str = attr.ib(default="hash")
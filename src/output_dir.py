@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+import re
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import attr
+
+from .atomic_write import atomic_write
+
+UNSAFE_FILENAME_CHARS_RE = re.compile(r"[^A-Za-z0-9_.$-]")
+
+
+def function_filename(name: str) -> str:
+    return UNSAFE_FILENAME_CHARS_RE.sub("_", name).lstrip(".") + ".c"
+
+
+def write_if_changed(path: str, content: str) -> bool:
+    """Atomically replace the file at path with the given content, unless it
+    already has that content, in which case it is left untouched so that its
+    modification time does not change. Return whether it was written."""
+    data = content.encode("utf-8")
+    try:
+        with open(path, "rb") as f:
+            if f.read() == data:
+                return False
+    except OSError:
+        pass
+    with atomic_write(path, "wb") as f:
+        f.write(data)
+    return True
+
+
+@attr.s
+class OutputDir:
+    """A directory with the output for each function in a file of its own,
+    and a manifest listing them in input order."""
+
+    path: str = attr.ib()
+    manifest_name: str = attr.ib(default="manifest.json")
+    entries: Dict[int, Dict[str, Any]] = attr.ib(factory=dict)
+    filenames: Dict[int, str] = attr.ib(factory=dict)
+    taken: Set[str] = attr.ib(factory=set)
+    written: int = attr.ib(default=0)
+    unchanged: int = attr.ib(default=0)
+
+    def assign(self, index: int, name: str) -> None:
+        """Pick the file name for a function. This must be done in input
+        order, so that when several functions have the same name, the first
+        one always gets the plain file name and the others their index (plus
+        a counter, if a function is actually named like that)."""
+        self.filenames[index] = self.reserve(index, name)
+
+    def reserve(self, index: int, name: str) -> str:
+        """Pick the file name for a function without writing it, e.g. for a
+        function of another shard writing to the same directory."""
+        filename = function_filename(name)
+        base = filename[:-2]
+        suffix = str(index)
+        counter = 1
+        while filename in self.taken:
+            filename = f"{base}-{suffix}.c"
+            suffix = f"{index}-{counter}"
+            counter += 1
+        self.taken.add(filename)
+        return filename
+
+    def write_function(
+        self, index: int, name: str, output: str, status: Optional[str]
+    ) -> None:
+        filename = self.filenames.pop(index)
+        content = output.rstrip("\n") + "\n"
+        if write_if_changed(os.path.join(self.path, filename), content):
+            self.written += 1
+        else:
+            self.unchanged += 1
+        entry: Dict[str, Any] = {
+            "index": index,
+            "name": name,
+            "file": filename,
+            "sha1": hashlib.sha1(content.encode("utf-8")).hexdigest(),
+        }
+        # The status is not known for output reused from an earlier run.
+        if status is not None:
+            entry["status"] = status
+        self.entries[index] = entry
+
+    def close(self) -> None:
+        functions: List[Dict[str, Any]] = [
+            self.entries[index] for index in sorted(self.entries)
+        ]
+        write_if_changed(
+            os.path.join(self.path, self.manifest_name),
+            json.dumps({"functions": functions}, indent=2) + "\n",
+        )
+
+
+def open_output_dir(path: str, shard: Optional[Tuple[int, int]] = None) -> OutputDir:
+    os.makedirs(path, exist_ok=True)
+    if shard is not None:
+        # Shards may share an output directory, but not a manifest.
+        return OutputDir(path, f"manifest-{shard[0]}-of-{shard[1]}.json")
+    return OutputDir(path)
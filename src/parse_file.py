@@ -1,11 +1,20 @@
+import concurrent.futures
+import copy
+import gc
+import hashlib
+import json
+import os
 import re
 import typing
-from typing import Any, Callable, Dict, Iterator, List, Optional, Union
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
 
 import attr
 
+from .asm_file import AsmFile, open_asm_file
+from .atomic_write import atomic_write
 from .options import Options
 from .parse_instruction import Instruction, Register, parse_instruction
+from .profiling import profiled
 
 
 @attr.s(frozen=True)
@@ -43,6 +52,29 @@ class Function:
 @attr.s
 class Rodata:
     values: Dict[str, List[str]] = attr.ib(factory=dict)
+    jump_tables: Dict[str, List[str]] = attr.ib(factory=dict, repr=False)
+
+    def merge(self, other: "Rodata") -> None:
+        for sym in other.values:
+            self.jump_tables.pop(sym, None)
+        self.values.update(other.values)
+
+    def jump_table(self, sym: str) -> Optional[List[str]]:
+        """Return the targets of the jump table at a given symbol, without
+        trailing padding, or None if the symbol is unknown. Entries are
+        decoded once and then shared by all functions using the table."""
+        entries = self.jump_tables.get(sym)
+        if entries is None:
+            if sym not in self.values:
+                return None
+            entries = []
+            for entry in self.values[sym]:
+                if entry == "0":
+                    # We have entered padding, stop reading.
+                    break
+                entries.append(entry)
+            self.jump_tables[sym] = entries
+        return entries
 
 
 @attr.s
@@ -52,6 +84,10 @@ class MIPSFile:
     rodata: Rodata = attr.ib(factory=Rodata)
     current_function: Optional[Function] = attr.ib(default=None, repr=False)
     current_rodata: List[str] = attr.ib(factory=list)
+    # The symbol that current_rodata holds values of. When parsing started
+    # partway through a file, current_rodata may hold only the values that
+    # came after that point.
+    current_rodata_symbol: Optional[str] = attr.ib(default=None)
 
     def new_function(self, name: str) -> None:
         self.current_function = Function(name=name)
@@ -71,6 +107,7 @@ class MIPSFile:
 
     def new_rodata_symbol(self, symbol_name: str) -> None:
         self.current_rodata = []
+        self.current_rodata_symbol = symbol_name
         self.rodata.values[symbol_name] = self.current_rodata
 
     def new_rodata_word(self, word: str) -> None:
@@ -81,91 +118,317 @@ class MIPSFile:
         return f"# {self.filename}\n{functions_str}"
 
 
-def parse_file(f: typing.TextIO, options: Options) -> MIPSFile:
-    mips_file: MIPSFile = MIPSFile(options.filename)
+@profiled("parse_file")
+def parse_file(f: typing.Iterable[str], options: Options) -> MIPSFile:
+    return parse_lines(f, options, MIPSFile(options.filename), rodata_only=False)
+
+
+def parse_rodata(f: typing.Iterable[str], options: Options) -> Rodata:
+    """Parse only the rodata of a file, skipping over the contents of .text
+    sections without parsing any instructions."""
+    return parse_lines(f, options, MIPSFile(options.filename), rodata_only=True).rodata
+
+
+# Rodata from --rodata files, keyed by a hash of their contents, together with
+# the preprocessor constants that were assumed to be unset while reading them.
+rodata_cache: Dict[str, Tuple[Rodata, List[str]]] = {}
+RODATA_CACHE_VERSION = 1
+
+
+def load_rodata_file(filename: str, options: Options) -> Rodata:
+    """Read the rodata of a file given by --rodata. Results are cached in
+    memory, and on disk if options.rodata_cache_dir is set, keyed by a hash of
+    the file's contents and of the preprocessor constants in effect."""
+    defines = options.preproc_defines
+    with open_asm_file(filename) as asm_file:
+        hasher = hashlib.sha1(asm_file.data)
+        hasher.update(json.dumps(sorted(defines.items())).encode("utf-8"))
+        key = f"{hasher.hexdigest()}-v{RODATA_CACHE_VERSION}"
+
+        cache_path = (
+            os.path.join(options.rodata_cache_dir, f"{key}.json")
+            if options.rodata_cache_dir
+            else None
+        )
+        if key not in rodata_cache and cache_path and os.path.exists(cache_path):
+            with open(cache_path, "r") as cf:
+                cached = json.load(cf)
+            rodata_cache[key] = (Rodata(cached["values"]), cached["assumed"])
+
+        if key in rodata_cache:
+            rodata, assumed = rodata_cache[key]
+            # Replay the effects reading the file would have had on the set of
+            # preprocessor constants.
+            for macro_name in assumed:
+                if macro_name not in defines:
+                    defines[macro_name] = 0
+                    print_assumed_unset(macro_name)
+            return Rodata(dict(rodata.values))
+
+        known = set(defines.keys())
+        rodata = parse_rodata(asm_file.lines(), options)
+        assumed = [d for d in defines if d not in known]
+        rodata_cache[key] = (rodata, assumed)
+
+    if cache_path:
+        assert options.rodata_cache_dir
+        os.makedirs(options.rodata_cache_dir, exist_ok=True)
+        with atomic_write(cache_path) as cf:
+            json.dump({"values": rodata.values, "assumed": assumed}, cf)
+    return Rodata(dict(rodata.values))
+
+
+def print_assumed_unset(macro_name: str) -> None:
+    print(
+        f"Note: assuming {macro_name} is unset for .ifdef, "
+        f"pass -D{macro_name}/-U{macro_name} to set/unset explicitly."
+    )
+
+
+# Block comments, and line comments starting with "#". These are matched in a
+# single left-to-right pass, so a "#" within a block comment is ignored.
+COMMENT_RE = re.compile(r"/\*.*?\*/|#.*$")
+# Classifies a line, with comments already stripped, in a single match. The
+# alternatives are tried in order, so e.g. a line starting with "." is a
+# directive unless it ends with ":", in which case it is a label. Directives
+# that are not interesting to the parser only match the "args" group.
+LINE_RE = re.compile(
+    r"\.(?P<directive>ifdef|ifndef|else|endif|macro|endm|section|rdata|rodata"
+    r"|late_rodata|text|word)?(?P<args>.*)(?<!:)$"
+    r"|(?P<label>\..*)$"
+    r"|glabel (?P<glabel>\S+)"
+    r"|(?P<func>func.*?):+$"
+    r"|(?P<instruction>.+)"
+)
+JUMPTABLE_LABEL_RE = re.compile(r"L(_U_)?[0-9A-F]{8}")
+
+
+@attr.s
+class ParserState:
+    """Section, .ifdef and rodata state, which carries over between lines."""
+
+    curr_section: str = attr.ib(default=".text")
+    ifdef_level: int = attr.ib(default=0)
+    ifdef_levels: List[int] = attr.ib(factory=list)
+    # The rodata symbol that .word directives add values to.
+    rodata_symbol: Optional[str] = attr.ib(default=None)
+
+
+def strip_comments(line: str) -> str:
+    """Strip comments from a line, and normalize its whitespace."""
+    if "/" in line or "#" in line:
+        line = COMMENT_RE.sub("", line)
+    return " ".join(line.split())
+
+
+def goto_pattern_matcher(goto_patterns: List[str]) -> Optional[typing.Pattern[str]]:
+    if not goto_patterns:
+        return None
+    return re.compile("|".join(re.escape(pattern) for pattern in goto_patterns))
+
+
+def parse_lines(
+    f: typing.Iterable[str],
+    options: Options,
+    mips_file: MIPSFile,
+    rodata_only: bool,
+    state: Optional[ParserState] = None,
+) -> MIPSFile:
+    """Parse lines into mips_file. If a state is given, parsing continues from
+    it, and it is updated to the state after the last line."""
+    for _ in parse_lines_iter(f, options, mips_file, rodata_only, state):
+        pass
+    return mips_file
+
+
+def iter_functions(f: typing.Iterable[str], options: Options) -> Iterator[Function]:
+    """Parse a file one function at a time, yielding each function once the
+    next function label (or the end of the file) is seen. Functions are not
+    kept around after being yielded, so memory use does not grow with the
+    size of the input. Rodata is only complete once the whole file has been
+    read, so it should be collected beforehand with parse_rodata."""
+    mips_file = MIPSFile(options.filename)
+    for function in parse_lines_iter(f, options, mips_file, rodata_only=False):
+        mips_file.functions.clear()
+        yield function
+
+
+def parse_lines_iter(
+    f: typing.Iterable[str],
+    options: Options,
+    mips_file: MIPSFile,
+    rodata_only: bool,
+    state: Optional[ParserState] = None,
+) -> Iterator[Function]:
+    """Like parse_lines, but yield each function of mips_file as soon as it
+    is complete."""
+    if state is None:
+        state = ParserState()
     defines: Dict[str, int] = options.preproc_defines
-    ifdef_level: int = 0
-    ifdef_levels: List[int] = []
-    curr_section = ".text"
+    ifdef_level: int = state.ifdef_level
+    ifdef_levels: List[int] = state.ifdef_levels
+    curr_section = state.curr_section
+    if state.rodata_symbol is not None:
+        mips_file.current_rodata_symbol = state.rodata_symbol
+    goto_matcher = None if rodata_only else goto_pattern_matcher(options.goto_patterns)
 
     for line in f:
+        if rodata_only and curr_section == ".text" and "." not in line:
+            # Neither a directive nor rodata, skip without further parsing.
+            continue
+
         # Check for goto markers before stripping comments
-        emit_goto = any(pattern in line for pattern in options.goto_patterns)
+        emit_goto = goto_matcher is not None and goto_matcher.search(line) is not None
 
         # Strip comments and whitespace
-        line = re.sub(r"/\*.*?\*/", "", line)
-        line = re.sub(r"#.*$", "", line)
-        line = re.sub(r"\s+", " ", line)
-        line = line.strip()
+        line = strip_comments(line)
 
         if line == "":
-            pass
-        elif line.startswith(".") and not line.endswith(":"):
+            continue
+        match = LINE_RE.match(line)
+        assert match is not None
+        kind = match.lastgroup
+        if kind == "args":
             # Assembler directive.
-            if line.startswith(".ifdef") or line.startswith(".ifndef"):
+            directive = match.group("directive")
+            if directive == "ifdef" or directive == "ifndef":
                 macro_name = line.split()[1]
                 if macro_name not in defines:
                     defines[macro_name] = 0
-                    print(
-                        f"Note: assuming {macro_name} is unset for .ifdef, "
-                        f"pass -D{macro_name}/-U{macro_name} to set/unset explicitly."
-                    )
+                    print_assumed_unset(macro_name)
                 level = defines[macro_name]
-                if line.startswith(".ifdef"):
+                if directive == "ifdef":
                     level = 1 - level
                 ifdef_level += level
                 ifdef_levels.append(level)
-            elif line.startswith(".else"):
+            elif directive == "else":
                 level = ifdef_levels.pop()
                 ifdef_level -= level
                 level = 1 - level
                 ifdef_level += level
                 ifdef_levels.append(level)
-            elif line.startswith(".endif"):
+            elif directive == "endif":
                 ifdef_level -= ifdef_levels.pop()
-            elif line.startswith(".macro"):
+            elif directive == "macro":
                 ifdef_level += 1
-            elif line.startswith(".endm"):
+            elif directive == "endm":
                 ifdef_level -= 1
             elif ifdef_level == 0:
-                if line.startswith(".section"):
+                if directive == "section":
                     curr_section = line.split(" ")[1].split(",")[0]
                     if curr_section == ".late_rodata":
                         curr_section = ".rodata"
                 elif (
-                    line.startswith(".rdata")
-                    or line.startswith(".rodata")
-                    or line.startswith(".late_rodata")
+                    directive == "rdata"
+                    or directive == "rodata"
+                    or directive == "late_rodata"
                 ):
                     curr_section = ".rodata"
-                elif line.startswith(".text"):
+                elif directive == "text":
                     curr_section = ".text"
-                elif line.startswith(".word") and curr_section == ".rodata":
-                    for w in line[5:].split(","):
+                elif directive == "word" and curr_section == ".rodata":
+                    for w in match.group("args").split(","):
                         mips_file.new_rodata_word(w.strip())
-        elif ifdef_level == 0:
-            if curr_section == ".rodata":
-                if line.startswith("glabel"):
-                    name = line.split(" ")[1]
-                    mips_file.new_rodata_symbol(name)
-            elif curr_section == ".text":
-                if line.startswith("."):
-                    # Label.
-                    label_name: str = line.strip(".: ")
-                    mips_file.new_label(label_name)
-                elif line.startswith("glabel"):
-                    # Function label.
-                    function_name: str = line.split(" ")[1]
-                    if re.match("L(_U_)?[0-9A-F]{8}", function_name):
-                        mips_file.new_jumptable_label(function_name)
-                    else:
-                        mips_file.new_function(function_name)
-                elif line.startswith("func") and line.endswith(":"):
-                    # Other kind of function label.
-                    mips_file.new_function(line.rstrip(":"))
+        elif ifdef_level != 0:
+            pass
+        elif curr_section == ".rodata":
+            if kind == "glabel":
+                mips_file.new_rodata_symbol(match.group("glabel"))
+        elif curr_section == ".text" and not rodata_only:
+            if kind == "instruction":
+                instr: Instruction = parse_instruction(line, emit_goto)
+                mips_file.new_instruction(instr)
+            elif kind == "label":
+                label_name: str = line.strip(".: ")
+                mips_file.new_label(label_name)
+            elif kind == "glabel":
+                # Function label.
+                function_name: str = match.group("glabel")
+                if JUMPTABLE_LABEL_RE.match(function_name):
+                    mips_file.new_jumptable_label(function_name)
                 else:
-                    # Instruction.
-                    instr: Instruction = parse_instruction(line, emit_goto)
-                    mips_file.new_instruction(instr)
+                    if mips_file.current_function is not None:
+                        yield mips_file.current_function
+                    mips_file.new_function(function_name)
+            else:
+                # Other kind of function label.
+                if mips_file.current_function is not None:
+                    yield mips_file.current_function
+                mips_file.new_function(match.group("func"))
+
+    state.curr_section = curr_section
+    state.ifdef_level = ifdef_level
+    state.rodata_symbol = mips_file.current_rodata_symbol
+    if mips_file.current_function is not None:
+        yield mips_file.current_function
+
+
+def parse_chunk(
+    filename: str, start: int, end: int, state: ParserState, options: Options
+) -> List[Function]:
+    # Parsing doesn't create reference cycles, so don't spend time looking for
+    # them. (Worker processes only ever parse.)
+    gc.disable()
+    with open_asm_file(filename) as asm_file:
+        mips_file = MIPSFile(filename)
+        parse_lines(asm_file.lines(start, end), options, mips_file, False, state)
+    return mips_file.functions
+
+
+@profiled("parse_file")
+def parse_file_parallel(asm_file: AsmFile, options: Options, jobs: int) -> MIPSFile:
+    """Parse a file using a pool of worker processes, with the same result as
+    parse_file.
+
+    The file is split at function labels. A quick scan over the file, which
+    only looks at directives and rodata, computes the parser state at each
+    split point and collects the file's rodata. Chunks of functions are then
+    parsed independently."""
+    mips_file = MIPSFile(options.filename)
+    state = ParserState()
+    splits: List[Tuple[int, ParserState]] = []
+    offsets = [b.offset for b in asm_file.boundaries() if b.kind == "glabel"]
+    offsets.append(len(asm_file.data))
+    parse_lines(asm_file.lines(0, offsets[0]), options, mips_file, True, state)
+    for start, end in zip(offsets, offsets[1:]):
+        if state.curr_section == ".text" and state.ifdef_level == 0:
+            line = strip_comments(next(asm_file.lines(start), ""))
+            if line.startswith("glabel ") and not JUMPTABLE_LABEL_RE.match(
+                line.split(" ")[1]
+            ):
+                splits.append((start, copy.deepcopy(state)))
+        parse_lines(asm_file.lines(start, end), options, mips_file, True, state)
+
+    if not splits or splits[0][0] != 0:
+        splits.insert(0, (0, ParserState()))
+
+    # Group functions into chunks of roughly equal size, a few per worker.
+    chunk_size = max(len(asm_file.data) // (jobs * 4), 1)
+    chunks: List[Tuple[int, int, ParserState]] = []
+    for (offset, split_state) in splits:
+        if chunks and offset - chunks[-1][0] < chunk_size:
+            continue
+        if chunks:
+            chunks[-1] = (chunks[-1][0], offset, chunks[-1][2])
+        chunks.append((offset, len(asm_file.data), split_state))
 
+    # Preprocessor constants have all been seen by now, so workers won't print
+    # any notes about them.
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(
+                parse_chunk, asm_file.filename, start, end, chunk_state, options
+            )
+            for (start, end, chunk_state) in chunks
+        ]
+        # Unpickling the results creates lots of small objects, none of which
+        # are garbage. Collecting cycles in the meantime is very slow.
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for future in futures:
+                mips_file.functions.extend(future.result())
+        finally:
+            if gc_was_enabled:
+                gc.enable()
     return mips_file
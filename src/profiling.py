@@ -0,0 +1,223 @@
+import cProfile
+import functools
+import io
+import json
+import pstats
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+    cast,
+)
+
+import attr
+
+# The phases that are timed, in the order they are shown in. Times are
+# inclusive, e.g. translate_to_ast contains build_blocks, and write_function
+# (output emission) contains build_flowgraph_between.
+PHASES = [
+    "parse_file",
+    "build_blocks",
+    "build_nodes",
+    "compute_dominators",
+    "translate_to_ast",
+    "assign_phis",
+    "build_flowgraph_between",
+    "write_function",
+]
+
+# Functions are identified by their index in the input and their name, since
+# names need not be unique.
+FunctionKey = Tuple[int, str]
+
+# Timings that are not specific to a single function, e.g. parsing the whole
+# file up front, are listed under this key.
+FILE_LEVEL: FunctionKey = (-1, "<file>")
+
+
+@attr.s
+class Profiler:
+    # Seconds spent in each phase, by function.
+    timings: Dict[FunctionKey, Dict[str, float]] = attr.ib(factory=dict)
+    current_function: FunctionKey = attr.ib(default=FILE_LEVEL)
+    active_phases: List[str] = attr.ib(factory=list)
+    # Function to run cProfile or tracemalloc on, and which of the two to use.
+    hook_function: Optional[str] = attr.ib(default=None)
+    hook: str = attr.ib(default="cprofile")
+
+    def add(self, phase: str, seconds: float) -> None:
+        timings = self.timings.setdefault(self.current_function, {})
+        timings[phase] = timings.get(phase, 0.0) + seconds
+
+    def merge(self, key: FunctionKey, phase_times: Dict[str, float]) -> None:
+        """Add timings measured elsewhere, e.g. in a worker process."""
+        timings = self.timings.setdefault(key, {})
+        for phase, seconds in phase_times.items():
+            timings[phase] = timings.get(phase, 0.0) + seconds
+
+    def labels(self) -> Dict[FunctionKey, str]:
+        """Name each function, adding its index to names that occur more than
+        once."""
+        counts: Dict[str, int] = {}
+        for _, name in self.timings:
+            counts[name] = counts.get(name, 0) + 1
+        return {
+            key: key[1] if counts[key[1]] == 1 else f"{key[1]} #{key[0]}"
+            for key in self.timings
+        }
+
+    def totals(self) -> Dict[str, float]:
+        ret: Dict[str, float] = {}
+        for timings in self.timings.values():
+            for phase, seconds in timings.items():
+                ret[phase] = ret.get(phase, 0.0) + seconds
+        return ret
+
+    def format_table(self) -> str:
+        phases = [p for p in PHASES if p in self.totals()]
+        labels = self.labels()
+        name_width = max([len(label) for label in labels.values()] + [len("total")])
+        widths = [max(len(p), 9) for p in phases]
+        lines = [
+            " ".join(
+                [" " * name_width]
+                + [p.rjust(width) for p, width in zip(phases, widths)]
+            )
+        ]
+        rows = [(labels[key], timings) for key, timings in self.timings.items()]
+        rows.append(("total", self.totals()))
+        for name, timings in rows:
+            cells = [
+                f"{timings[p] * 1000:.2f}ms" if p in timings else "-" for p in phases
+            ]
+            lines.append(
+                " ".join(
+                    [name.ljust(name_width)]
+                    + [cell.rjust(width) for cell, width in zip(cells, widths)]
+                )
+            )
+        return "\n".join(lines)
+
+    def format_json(self) -> str:
+        labels = self.labels()
+        functions = {labels[key]: timings for key, timings in self.timings.items()}
+        return json.dumps({"functions": functions, "total": self.totals()}, indent=2)
+
+
+# The active profiler. Profiling is disabled when this is None, in which case
+# the hooks below do nothing but check it.
+profiler: Optional[Profiler] = None
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+def profiled(phase: str) -> Callable[[F], F]:
+    """Decorate a function to have its running time counted towards the given
+    phase. Recursive calls are only counted once."""
+
+    def decorator(fn: F) -> F:
+        @functools.wraps(fn)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            prof = profiler
+            if prof is None or phase in prof.active_phases:
+                return fn(*args, **kwargs)
+            prof.active_phases.append(phase)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                prof.add(phase, time.perf_counter() - start)
+                prof.active_phases.pop()
+
+        return cast(F, wrapper)
+
+    return decorator
+
+
+@contextmanager
+def profile_function(name: str, index: int) -> Iterator[None]:
+    """Attribute timings to a function while decompiling it, and run the
+    cProfile or tracemalloc hook if it was asked for this function."""
+    prof = profiler
+    if prof is None:
+        yield
+        return
+    prof.current_function = (index, name)
+    try:
+        if prof.hook_function != name:
+            yield
+        elif prof.hook == "tracemalloc":
+            with tracemalloc_hook(name):
+                yield
+        else:
+            with cprofile_hook(name):
+                yield
+    finally:
+        prof.current_function = FILE_LEVEL
+
+
+def profile_parse(functions: Iterable[Any]) -> Iterator[Any]:
+    """Count the time taken to produce each function from a streaming parser
+    towards parse_file for that function."""
+    it = iter(functions)
+    index = 0
+    while True:
+        prof = profiler
+        start = time.perf_counter()
+        try:
+            function = next(it)
+        except StopIteration:
+            return
+        if prof is not None:
+            prof.current_function = (index, function.name)
+            prof.add("parse_file", time.perf_counter() - start)
+            prof.current_function = FILE_LEVEL
+        index += 1
+        yield function
+
+
+@contextmanager
+def cprofile_hook(name: str) -> Iterator[None]:
+    prof = cProfile.Profile()
+    prof.enable()
+    try:
+        yield
+    finally:
+        prof.disable()
+        out = io.StringIO()
+        out.write(f"cProfile results for {name}:\n")
+        pstats.Stats(prof, stream=out).sort_stats("cumulative").print_stats(30)
+        report(out.getvalue())
+
+
+@contextmanager
+def tracemalloc_hook(name: str) -> Iterator[None]:
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    try:
+        yield
+    finally:
+        after = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        if not was_tracing:
+            tracemalloc.stop()
+        lines = [f"tracemalloc results for {name}: peak {peak / 1024:.1f} KiB"]
+        for stat in after.compare_to(before, "lineno")[:20]:
+            lines.append(str(stat))
+        report("\n".join(lines))
+
+
+def report(text: str) -> None:
+    print(text, file=sys.stderr)
@@ -0,0 +1,133 @@
+import hashlib
+import json
+import sqlite3
+from typing import Optional
+
+import attr
+
+from .incremental import source_hash
+from .options import Options
+
+# Version of the database layout. The decompiler's own version, source_hash(),
+# is part of every key instead, so that a new version never reuses stale
+# results.
+RESULT_CACHE_SCHEMA_VERSION = 1
+
+
+def result_cache_key(fn_hash: str, options: Options) -> str:
+    """Combine a function's function_hash, which covers its instructions and
+    the rodata it refers to, with the options that affect its output."""
+    fields = [
+        source_hash(),
+        fn_hash,
+        options.void,
+        options.ifs,
+        options.andor_detection,
+        options.goto_patterns,
+        sorted(options.preproc_defines.items()),
+        options.debug,
+        options.stop_on_error,
+        options.print_assembly,
+        options.structure_budget,
+    ]
+    return hashlib.sha1(json.dumps(fields).encode("utf-8")).hexdigest()
+
+
+@attr.s
+class CacheStats:
+    hits: int = attr.ib(default=0)
+    misses: int = attr.ib(default=0)
+    evictions: int = attr.ib(default=0)
+
+    def __str__(self) -> str:
+        return f"{self.hits} hits, {self.misses} misses, {self.evictions} evictions"
+
+
+@attr.s
+class ResultCache:
+    """Decompiled output stored in an SQLite database, keyed by
+    result_cache_key. When the total size of the stored output goes above
+    max_size, the least recently used entries are evicted."""
+
+    conn: sqlite3.Connection = attr.ib(repr=False)
+    max_size: int = attr.ib()
+    total_size: int = attr.ib()
+    clock: int = attr.ib()
+    stats: CacheStats = attr.ib(factory=CacheStats)
+
+    def get(self, key: str) -> Optional[str]:
+        row = self.conn.execute(
+            "SELECT output FROM results WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            self.stats.misses += 1
+            return None
+        self.stats.hits += 1
+        self.clock += 1
+        self.conn.execute(
+            "UPDATE results SET last_used = ? WHERE key = ?", (self.clock, key)
+        )
+        return str(row[0])
+
+    def put(self, key: str, output: str) -> None:
+        size = len(output.encode("utf-8"))
+        if size > self.max_size:
+            return
+        row = self.conn.execute(
+            "SELECT size FROM results WHERE key = ?", (key,)
+        ).fetchone()
+        if row is not None:
+            self.total_size -= row[0]
+        self.clock += 1
+        self.conn.execute(
+            "INSERT OR REPLACE INTO results (key, output, size, last_used) "
+            "VALUES (?, ?, ?, ?)",
+            (key, output, size, self.clock),
+        )
+        self.total_size += size
+        if self.total_size > self.max_size:
+            self.evict()
+
+    def evict(self) -> None:
+        cursor = self.conn.execute(
+            "SELECT key, size FROM results ORDER BY last_used ASC"
+        )
+        evicted = []
+        for key, size in cursor:
+            if self.total_size <= self.max_size:
+                break
+            evicted.append((key,))
+            self.total_size -= size
+        cursor.close()
+        self.conn.executemany("DELETE FROM results WHERE key = ?", evicted)
+        self.stats.evictions += len(evicted)
+
+    def close(self) -> None:
+        self.conn.commit()
+        self.conn.close()
+
+
+def open_result_cache(filename: str, max_size: int) -> ResultCache:
+    conn = sqlite3.connect(filename)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)"
+    )
+    row = conn.execute("SELECT value FROM meta WHERE name = 'version'").fetchone()
+    if row is None or row[0] != RESULT_CACHE_SCHEMA_VERSION:
+        conn.execute("DROP TABLE IF EXISTS results")
+        conn.execute(
+            "INSERT OR REPLACE INTO meta (name, value) VALUES ('version', ?)",
+            (RESULT_CACHE_SCHEMA_VERSION,),
+        )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS results ("
+        "key TEXT PRIMARY KEY, output TEXT, size INTEGER, last_used INTEGER)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+    total_size, clock = conn.execute(
+        "SELECT COALESCE(SUM(size), 0), COALESCE(MAX(last_used), 0) FROM results"
+    ).fetchone()
+    cache = ResultCache(conn, max_size, total_size, clock)
+    if total_size > max_size:
+        cache.evict()
+    return cache
@@ -0,0 +1,158 @@
+import json
+import os
+import sqlite3
+import time
+from typing import Dict, Optional
+
+import attr
+
+from .incremental import options_fingerprint
+from .options import Options
+
+RESULTS_DB_SCHEMA_VERSION = 2
+
+# How often to commit results to the database, in seconds.
+COMMIT_INTERVAL = 1.0
+
+
+@attr.s
+class ResultsDb:
+    """Results of batch runs in an SQLite database, one row per function and
+    set of options, for querying afterwards, e.g.
+
+        SELECT name, error FROM functions WHERE status = 'ERROR';
+        SELECT name, elapsed FROM functions ORDER BY elapsed DESC LIMIT 10;
+
+    Rows are keyed by the name and input hash of the function, since names
+    need not be unique. Functions that already have a row with the same
+    input and options hashes are not decompiled again."""
+
+    conn: sqlite3.Connection = attr.ib(repr=False)
+    filename: str = attr.ib()
+    options_hash: str = attr.ib()
+    # Identifies this run in the last_seen column, to find rows for functions
+    # that are no longer in the input.
+    run_id: float = attr.ib(factory=time.time)
+    last_commit: float = attr.ib(factory=time.monotonic)
+    hits: int = attr.ib(default=0)
+    stored: int = attr.ib(default=0)
+
+    def lookup(self, index: int, name: str, input_hash: str) -> Optional[str]:
+        key = (self.filename, self.options_hash, name, input_hash)
+        row = self.conn.execute(
+            "SELECT output FROM functions "
+            "WHERE filename = ? AND options_hash = ? AND name = ? "
+            "AND input_hash = ?",
+            key,
+        ).fetchone()
+        if row is None:
+            return None
+        self.conn.execute(
+            "UPDATE functions SET function_index = ?, last_seen = ? "
+            "WHERE filename = ? AND options_hash = ? AND name = ? "
+            "AND input_hash = ?",
+            (index, self.run_id, *key),
+        )
+        self.maybe_commit()
+        self.hits += 1
+        return str(row[0])
+
+    def store(
+        self,
+        index: int,
+        name: str,
+        input_hash: str,
+        status: str,
+        output: str,
+        error: Optional[str],
+        elapsed: float,
+        phase_times: Dict[str, float],
+        instructions: int,
+        nodes: Optional[int],
+    ) -> None:
+        self.conn.execute(
+            "INSERT OR REPLACE INTO functions (filename, options_hash, name, "
+            "input_hash, function_index, status, error, output, elapsed, "
+            "phase_times, instructions, nodes, created, last_seen) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                self.filename,
+                self.options_hash,
+                name,
+                input_hash,
+                index,
+                status,
+                error,
+                output,
+                elapsed,
+                json.dumps(phase_times),
+                instructions,
+                nodes,
+                time.time(),
+                self.run_id,
+            ),
+        )
+        self.stored += 1
+        self.maybe_commit()
+
+    def maybe_commit(self) -> None:
+        now = time.monotonic()
+        if now - self.last_commit >= COMMIT_INTERVAL:
+            self.conn.commit()
+            self.last_commit = now
+
+    def close(self, saw_all_functions: bool) -> None:
+        """Commit and close the database. If every function of the input was
+        looked up or stored, rows for functions that were not are deleted,
+        since they have been changed or removed."""
+        if saw_all_functions:
+            self.conn.execute(
+                "DELETE FROM functions "
+                "WHERE filename = ? AND options_hash = ? AND last_seen != ?",
+                (self.filename, self.options_hash, self.run_id),
+            )
+        self.conn.commit()
+        self.conn.close()
+
+
+def open_results_db(filename: str, options: Options) -> ResultsDb:
+    conn = sqlite3.connect(filename)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)"
+    )
+    row = conn.execute("SELECT value FROM meta WHERE name = 'version'").fetchone()
+    if row is None or row[0] != RESULTS_DB_SCHEMA_VERSION:
+        conn.execute("DROP TABLE IF EXISTS functions")
+        conn.execute(
+            "INSERT OR REPLACE INTO meta (name, value) VALUES ('version', ?)",
+            (RESULTS_DB_SCHEMA_VERSION,),
+        )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS functions ("
+        "filename TEXT NOT NULL, "
+        "options_hash TEXT NOT NULL, "
+        "name TEXT NOT NULL, "
+        "input_hash TEXT NOT NULL, "
+        # Index of the function in the input, as of the last run.
+        "function_index INTEGER NOT NULL, "
+        "status TEXT NOT NULL, "
+        "error TEXT, "
+        "output TEXT NOT NULL, "
+        "elapsed REAL, "
+        # Seconds spent in each phase, as a JSON object.
+        "phase_times TEXT, "
+        "instructions INTEGER, "
+        # Number of flow graph nodes, if decompilation got that far.
+        "nodes INTEGER, "
+        "created REAL, "
+        "last_seen REAL, "
+        "PRIMARY KEY (filename, options_hash, name, input_hash))"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS functions_name ON functions (name)")
+    conn.execute("CREATE INDEX IF NOT EXISTS functions_status ON functions (status)")
+    conn.commit()
+    return ResultsDb(
+        conn,
+        filename=os.path.abspath(options.filename),
+        options_hash=options_fingerprint(options),
+    )
@@ -0,0 +1,256 @@
+import concurrent.futures
+import contextlib
+import hashlib
+import io
+import json
+import os
+import signal
+import socketserver
+import sys
+import threading
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import attr
+
+from .asm_file import open_asm_file
+from .main import decompile_selected
+from .options import DEFAULT_STRUCTURE_BUDGET, Options
+from .parse_file import MIPSFile, Rodata, load_rodata_file, parse_file
+from .shard import stable_hash
+
+# How many parsed files each worker keeps around.
+MAX_WARM_FILES = 16
+
+
+@attr.s
+class WarmFile:
+    mtime_ns: int = attr.ib()
+    size: int = attr.ib()
+    sha1: str = attr.ib()
+    mips_file: MIPSFile = attr.ib(repr=False)
+    # Output from parsing the file, i.e. notes about preprocessor constants.
+    parse_output: str = attr.ib()
+    preproc_defines: Dict[str, int] = attr.ib()
+
+
+# Parsed files of the current worker process, keyed by filename and the
+# preprocessor constants given, in least recently used order.
+warm_files: Dict[Tuple[str, str], WarmFile] = {}
+
+
+def file_sha1(filename: str) -> str:
+    with open_asm_file(filename) as asm_file:
+        return hashlib.sha1(asm_file.data).hexdigest()
+
+
+def get_warm_file(options: Options) -> WarmFile:
+    """Parse the file given by options, or reuse an earlier parse of it if the
+    file has not changed since. Changes are detected by modification time and
+    size, falling back to a hash of the contents if those differ."""
+    filename = os.path.abspath(options.filename)
+    key = (filename, json.dumps(sorted(options.preproc_defines.items())))
+    st = os.stat(filename)
+    warm = warm_files.pop(key, None)
+    if warm is not None and (warm.mtime_ns, warm.size) != (st.st_mtime_ns, st.st_size):
+        if warm.sha1 == file_sha1(filename):
+            warm.mtime_ns, warm.size = st.st_mtime_ns, st.st_size
+        else:
+            warm = None
+
+    if warm is None:
+        sha1 = file_sha1(filename)
+        with contextlib.redirect_stdout(io.StringIO()) as f:
+            with open_asm_file(filename) as asm_file:
+                mips_file = parse_file(asm_file.lines(), options)
+        warm = WarmFile(
+            mtime_ns=st.st_mtime_ns,
+            size=st.st_size,
+            sha1=sha1,
+            mips_file=mips_file,
+            parse_output=f.getvalue(),
+            preproc_defines=dict(options.preproc_defines),
+        )
+
+    warm_files[key] = warm
+    while len(warm_files) > MAX_WARM_FILES:
+        del warm_files[next(iter(warm_files))]
+    return warm
+
+
+def request_options(request: Dict[str, Any]) -> Options:
+    """Build Options for a request, with the same defaults as the command line.
+    Options are given by the names of the Options fields."""
+    opts = request.get("options", {})
+    return Options(
+        filename=request["filename"],
+        debug=bool(opts.get("debug", False)),
+        void=bool(opts.get("void", False)),
+        ifs=bool(opts.get("ifs", True)),
+        andor_detection=bool(opts.get("andor_detection", True)),
+        goto_patterns=list(opts.get("goto_patterns", ["GOTO"])),
+        rodata_files=list(opts.get("rodata_files", [])),
+        stop_on_error=bool(opts.get("stop_on_error", False)),
+        print_assembly=bool(opts.get("print_assembly", False)),
+        visualize_flowgraph=False,
+        preproc_defines=dict(opts.get("preproc_defines", {})),
+        # As on the command line, 0 means no limit.
+        structure_budget=int(opts.get("structure_budget", DEFAULT_STRUCTURE_BUDGET))
+        or None,
+    )
+
+
+def handle_request(request: Dict[str, Any]) -> Dict[str, Any]:
+    """Decompile the function(s) asked for by a request, and return the output
+    together with the exit code mips_to_c would have had."""
+    options = request_options(request)
+    warm = get_warm_file(options)
+    options.preproc_defines = dict(warm.preproc_defines)
+
+    # Decompilation must not change the shared parsed file, so give it its own
+    # copy of the rodata to merge --rodata files into.
+    mips_file = attr.evolve(
+        warm.mips_file, rodata=Rodata(dict(warm.mips_file.rodata.values))
+    )
+    out = io.StringIO()
+    err = io.StringIO()
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+        for rodata_file in options.rodata_files:
+            mips_file.rodata.merge(load_rodata_file(rodata_file, options))
+        function = str(request.get("function", "all"))
+        ret = decompile_selected(options, mips_file, function)
+    return {
+        "status": ret,
+        "output": warm.parse_output + out.getvalue(),
+        "errors": err.getvalue(),
+    }
+
+
+def handle_request_safe(request: Dict[str, Any]) -> Dict[str, Any]:
+    try:
+        return handle_request(request)
+    except Exception as e:
+        return {"error": f"{type(e).__name__}: {e}"}
+
+
+@attr.s
+class Server:
+    """Answers JSON-lines requests using a set of worker processes, each of
+    which keeps its own set of warm parsed files. Requests for a file always
+    go to the same worker, so each file is only parsed by one of them.
+    Responses are written as soon as they are ready, so they may come in a
+    different order than the requests; they are matched up by the "id" of
+    the request."""
+
+    # Executors with a single worker process each.
+    executors: List[concurrent.futures.Executor] = attr.ib()
+
+    def executor_for(self, filename: str) -> concurrent.futures.Executor:
+        index = stable_hash(os.path.abspath(filename)) % len(self.executors)
+        return self.executors[index]
+
+    def handle_line(
+        self, line: str, respond: Callable[[Dict[str, Any]], None]
+    ) -> threading.Event:
+        """Start handling a request. The returned event is set once the
+        response has been written."""
+        responded = threading.Event()
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict) or not isinstance(
+                request.get("filename"), str
+            ):
+                raise ValueError('requests must be objects with a "filename"')
+        except ValueError as e:
+            respond({"id": None, "error": f"Bad request: {e}"})
+            responded.set()
+            return responded
+        request_id = request.get("id")
+
+        def done(future: "concurrent.futures.Future[Dict[str, Any]]") -> None:
+            try:
+                response = future.result()
+            except Exception as e:
+                response = {"error": f"{type(e).__name__}: {e}"}
+            try:
+                respond({"id": request_id, **response})
+            finally:
+                responded.set()
+
+        executor = self.executor_for(request["filename"])
+        executor.submit(handle_request_safe, request).add_done_callback(done)
+        return responded
+
+    def serve_lines(
+        self, lines: Iterator[str], respond: Callable[[Dict[str, Any]], None]
+    ) -> None:
+        """Handle requests until the input ends, then wait for all of them to
+        be answered."""
+        pending = [self.handle_line(line, respond) for line in lines if line.strip()]
+        for responded in pending:
+            responded.wait()
+
+
+@contextlib.contextmanager
+def worker_executors(workers: int) -> Iterator[List[concurrent.futures.Executor]]:
+    with contextlib.ExitStack() as stack:
+        yield [
+            stack.enter_context(concurrent.futures.ProcessPoolExecutor(1))
+            for _ in range(workers)
+        ]
+
+
+def serve_stdio(workers: int) -> int:
+    lock = threading.Lock()
+
+    def respond(response: Dict[str, Any]) -> None:
+        with lock:
+            sys.stdout.write(json.dumps(response) + "\n")
+            sys.stdout.flush()
+
+    with worker_executors(workers) as executors:
+        Server(executors).serve_lines(iter(sys.stdin), respond)
+    return 0
+
+
+def serve_unix_socket(path: str, workers: int) -> int:
+    with worker_executors(workers) as executors:
+        server = Server(executors)
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self) -> None:
+                lock = threading.Lock()
+
+                def respond(response: Dict[str, Any]) -> None:
+                    data = (json.dumps(response) + "\n").encode("utf-8")
+                    with lock:
+                        try:
+                            self.wfile.write(data)
+                            self.wfile.flush()
+                        except OSError:
+                            # The client went away.
+                            pass
+
+                lines = (line.decode("utf-8") for line in self.rfile)
+                server.serve_lines(lines, respond)
+
+        if os.path.exists(path):
+            os.unlink(path)
+        # Exit cleanly on SIGTERM as well, so that the socket is removed.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        with socketserver.ThreadingUnixStreamServer(path, Handler) as sock_server:
+            try:
+                sock_server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os.unlink(path)
+    return 0
+
+
+def serve(address: str, workers: Optional[int]) -> int:
+    """Serve requests on stdin/stdout if address is "-", and on a Unix socket
+    at that path otherwise."""
+    workers = workers or os.cpu_count() or 1
+    if address == "-":
+        return serve_stdio(workers)
+    return serve_unix_socket(address, workers)
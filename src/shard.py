@@ -0,0 +1,174 @@
+import hashlib
+import re
+import sys
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    TextIO,
+    Tuple,
+)
+
+import attr
+
+from .parse_file import Function, Instruction
+
+# Every function in the output of a shard is preceded by a marker line with its
+# index in the input file, so that the shards can be merged back in order.
+MARKER_PREFIX = "// mips_to_c: function "
+MARKER_RE = re.compile(r"// mips_to_c: function (\d+) (\S+)$")
+TRAILER_RE = re.compile(r"// mips_to_c: end of shard (\d+)/(\d+) of (\d+) functions$")
+
+
+def parse_shard(text: str) -> Tuple[int, int]:
+    """Parse a shard given as "K/N", where 1 <= K <= N."""
+    shard_str, _, count_str = text.partition("/")
+    try:
+        shard, count = int(shard_str), int(count_str)
+    except ValueError:
+        raise ValueError(f"shard must be given as K/N, not {text!r}")
+    if not 1 <= shard <= count:
+        raise ValueError(f"shard {shard} is not between 1 and {count}")
+    return shard, count
+
+
+def stable_hash(name: str) -> int:
+    """Unlike hash(), this is the same across runs and machines."""
+    return int(hashlib.sha1(name.encode("utf-8")).hexdigest()[:16], 16)
+
+
+def function_weight(function: Function) -> int:
+    return sum(1 for item in function.body if isinstance(item, Instruction))
+
+
+@attr.s
+class Sharder:
+    """Picks out the functions belonging to one of several shards, either by
+    a hash of their name, or by spreading instruction counts evenly."""
+
+    shard: int = attr.ib()
+    count: int = attr.ib()
+    by: str = attr.ib(default="hash")
+    # Number of functions in the input, once all have been seen.
+    total: int = attr.ib(default=0)
+
+    def select(
+        self,
+        functions: Iterable[Function],
+        skipped: Optional[Callable[[int, Function], None]] = None,
+    ) -> Iterator[Tuple[int, Function]]:
+        """Yield the functions of this shard along with their indices in the
+        input. Functions of other shards are passed to skipped instead, if
+        given, so that all functions are seen in input order."""
+        if self.by == "size":
+            indexed = list(enumerate(functions))
+            self.total = len(indexed)
+            assignment = self.assign_by_size([fn for _, fn in indexed])
+            for index, fn in indexed:
+                if assignment[index] == self.shard - 1:
+                    yield index, fn
+                elif skipped is not None:
+                    skipped(index, fn)
+            return
+
+        # Hashing only needs one function at a time, so stream them.
+        self.total = 0
+        for index, fn in enumerate(functions):
+            self.total = index + 1
+            if stable_hash(fn.name) % self.count == self.shard - 1:
+                yield index, fn
+            elif skipped is not None:
+                skipped(index, fn)
+
+    def assign_by_size(self, functions: List[Function]) -> List[int]:
+        """Assign functions to shards, largest first, each to the shard with
+        the fewest instructions so far. Ties are broken by index, so every
+        shard comes up with the same assignment."""
+        weights = [function_weight(fn) for fn in functions]
+        loads = [0] * self.count
+        assignment = [0] * len(functions)
+        for index in sorted(range(len(functions)), key=lambda i: (-weights[i], i)):
+            shard = min(range(self.count), key=lambda s: (loads[s], s))
+            assignment[index] = shard
+            loads[shard] += weights[index]
+        return assignment
+
+    def marker(self, index: int, function: Function) -> str:
+        return f"{MARKER_PREFIX}{index} {function.name}\n"
+
+    def trailer(self) -> str:
+        return (
+            f"// mips_to_c: end of shard {self.shard}/{self.count} "
+            f"of {self.total} functions\n"
+        )
+
+
+def merge_shards(inputs: Iterable[TextIO], out: TextIO) -> int:
+    """Reassemble the outputs of all shards of a run, with functions in the
+    order of the input file. Anything printed before the first function,
+    e.g. notes about preprocessor constants, is the same for every shard and
+    is kept only once."""
+    chunks: Dict[int, str] = {}
+    preamble: Optional[str] = None
+    shards_seen: Dict[int, int] = {}
+    totals = set()
+    for f in inputs:
+        index: Optional[int] = None
+        lines: List[str] = []
+        file_preamble: List[str] = []
+        trailer_found = False
+        for line in f:
+            marker = MARKER_RE.match(line.rstrip("\n"))
+            trailer = TRAILER_RE.match(line.rstrip("\n"))
+            if marker or trailer:
+                if index is not None:
+                    chunks[index] = "".join(lines)
+                lines = []
+            if marker:
+                index = int(marker.group(1))
+                if index in chunks:
+                    print(f"Function {index} appears in two shards.", file=sys.stderr)
+                    return 1
+            elif trailer:
+                index = None
+                trailer_found = True
+                shard, count, total = map(int, trailer.groups())
+                shards_seen[shard] = count
+                totals.add(total)
+            elif index is None:
+                file_preamble.append(line)
+            else:
+                lines.append(line)
+        if index is not None:
+            chunks[index] = "".join(lines)
+        if not trailer_found:
+            print(
+                f"{getattr(f, 'name', 'Input')} is not the complete output of a shard.",
+                file=sys.stderr,
+            )
+            return 1
+        if preamble is None:
+            preamble = "".join(file_preamble)
+
+    counts = set(shards_seen.values())
+    if len(counts) != 1 or len(totals) != 1:
+        print("Shards come from different runs.", file=sys.stderr)
+        return 1
+    count = counts.pop()
+    total = totals.pop()
+    missing_shards = sorted(set(range(1, count + 1)) - set(shards_seen))
+    if missing_shards:
+        missing = ", ".join(f"{s}/{count}" for s in missing_shards)
+        print(f"Missing shards: {missing}.", file=sys.stderr)
+        return 1
+    if sorted(chunks) != list(range(total)):
+        print("Shards do not cover every function exactly once.", file=sys.stderr)
+        return 1
+
+    out.write(preamble or "")
+    for index in range(total):
+        out.write(chunks[index])
+    return 0
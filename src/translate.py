@@ -39,6 +39,7 @@ from .parse_instruction import (
     Macro,
     Register,
 )
+from .profiling import profiled
 
 ARGUMENT_REGS = list(map(Register, ["a0", "a1", "a2", "a3", "f12", "f14"]))
 
@@ -1778,6 +1779,7 @@ def reg_always_set(node: Node, reg: Register, dom_set: bool) -> bool:
     return True
 
 
+@profiled("assign_phis")
 def assign_phis(used_phis: List[PhiExpr], stack_info: StackInfo) -> None:
     i = 0
     # Iterate over used phis until there are no more remaining. New ones may
@@ -2193,6 +2195,7 @@ class FunctionInfo:
     flow_graph: FlowGraph = attr.ib()
 
 
+@profiled("translate_to_ast")
 def translate_to_ast(
     function: Function, options: Options, rodata: Rodata
 ) -> FunctionInfo: